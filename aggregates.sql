@@ -0,0 +1,25 @@
+UPDATE programs SET review_count = 0, grade_sum = 0;
+
+UPDATE programs SET review_count = r.review_count, grade_sum = r.grade_sum
+FROM (SELECT program, COUNT(*) AS review_count, SUM(grade) AS grade_sum
+      FROM reviews GROUP BY program) r
+WHERE programs.id = r.program;
+
+UPDATE users SET review_count = 0, grade_sum = 0;
+
+UPDATE users SET review_count = r.review_count, grade_sum = r.grade_sum
+FROM (SELECT author, COUNT(*) AS review_count, SUM(grade) AS grade_sum
+      FROM reviews GROUP BY author) r
+WHERE users.id = r.author;
+
+UPDATE users SET program_count = 0, received_grade_sum = 0,
+received_weight = 0;
+
+UPDATE users SET program_count = p.program_count,
+received_grade_sum = p.grade_sum, received_weight = p.weight
+FROM (SELECT author, COUNT(*) AS program_count, SUM(grade_sum) AS grade_sum,
+      SUM(MAX(review_count, 1)) AS weight FROM programs GROUP BY author) p
+WHERE users.id = p.author;
+
+UPDATE class_value SET program_count = (SELECT COUNT(*)
+FROM program_class_value pcv WHERE pcv.value = class_value.id);
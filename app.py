@@ -1,38 +1,304 @@
+import gzip
+import hashlib
+import json
+import os
+import re
 import secrets
+import time
+import zlib
+from collections import deque
+from dataclasses import asdict
+from datetime import datetime, timezone
 from functools import wraps
 
+import click
 import markupsafe
-from flask import Flask, abort, flash, redirect, render_template, request, session
+from flask import (
+    Flask,
+    abort,
+    before_render_template,
+    flash,
+    g,
+    jsonify,
+    make_response,
+    redirect,
+    render_template,
+    request,
+    session,
+    stream_with_context,
+    template_rendered,
+    url_for,
+)
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
 
 import config
+import outbox
+from cache import MemoryCache, cache
+from db import db
+from pagination import page_cursors
+from passwords import HashQueueFull
 from program import (
+    RANKINGS,
     ProgramExists,
     ProgramNotFound,
     ReviewedAlready,
     class_ids,
     create_program,
     delete_program,
+    get_class_catalogue,
     get_classes,
+    get_content_version,
+    get_facets,
     get_program,
+    get_program_version,
     get_programs,
     get_reviews,
+    iterate_programs,
+    refresh_rankings,
     review_program,
     search_programs,
     update_program,
 )
+from ratelimit import RateLimiter
 from user import (
     UserExists,
     UserNotFound,
     WrongCredentials,
     create_user,
+    get_user_version,
     login,
     user_programs,
     user_stats,
 )
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# runs of more than one line break
+LINE_BREAKS = re.compile("\n\n+")
+
 app = Flask(__name__)
 app.secret_key = config.SECRET_KEY
 
+# request.remote_addr is the address of the client instead of the proxy
+if config.TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.TRUSTED_PROXIES)
+
+# Returns the application with its database opened, so that a worker process
+# is ready before its first request. Importing the module alone leaves the
+# database to be opened on first use. The outbox workers start here too, so
+# that events left by other or earlier processes are handled without waiting
+# for this process to add one.
+def create_app():
+    db.open()
+
+    if config.OUTBOX_WORKERS > 0:
+        outbox.start_workers()
+
+    return app
+
+# every request uses a single pooled connection for all of its queries
+@app.teardown_appcontext
+def release_connection(exception):
+    db.release()
+
+# Pages are read from a replica if there are any. A client that has written
+# something reads from the primary until a replica has caught up with its
+# write, so it sees what it created or reviewed. Forms are always handled on
+# the primary, as they act on the latest data, such as a just registered user.
+# The debug endpoints show the state of the primary.
+@app.before_request
+def choose_replica():
+    if (request.method not in ("GET", "HEAD") or not db.replicas
+        or request.path.startswith("/debug/")):
+        return
+
+    if db.use_replica(session.get("read_version")):
+        session.pop("read_version", None)
+
+@app.after_request
+def remember_write(response):
+    if db.has_written():
+        session["read_version"] = get_content_version()
+
+    return response
+
+# the timings of the latest requests for /debug/stats
+request_timings = deque(maxlen=100)
+
+@app.before_request
+def start_profile():
+    if config.PROFILE_REQUESTS:
+        g.request_start = time.perf_counter()
+        g.render_time = 0.0
+        g.render_depth = 0
+        db.start_profile()
+
+# program cards are rendered inside the page template, so only the outermost
+# template is timed
+@before_render_template.connect_via(app)
+def template_started(sender, template, context, **extra):
+    if "render_depth" in g:
+        if g.render_depth == 0:
+            g.render_start = time.perf_counter()
+
+        g.render_depth += 1
+
+@template_rendered.connect_via(app)
+def template_finished(sender, template, context, **extra):
+    if "render_depth" in g:
+        g.render_depth -= 1
+
+        if g.render_depth == 0:
+            g.render_time += time.perf_counter() - g.render_start
+
+@app.after_request
+def finish_profile(response):
+    profile = db.stop_profile()
+
+    if profile is None or "request_start" not in g:
+        return response
+
+    total = time.perf_counter() - g.request_start
+
+    # the timings tell about the data behind the page, so they are only
+    # shown when debugging
+    if config.DEBUG_ENDPOINTS:
+        response.headers["Server-Timing"] = (
+            f'db;dur={profile.duration * 1000:.2f};'
+            f'desc="{len(profile.queries)} queries", '
+            f"render;dur={g.render_time * 1000:.2f}, "
+            f"total;dur={total * 1000:.2f}")
+
+    request_timings.append({
+        "path": request.full_path,
+        "status": response.status_code,
+        "total_ms": total * 1000,
+        "db_ms": profile.duration * 1000,
+        "render_ms": g.render_time * 1000,
+        "queries": [{"sql": query.sql, "ms": query.duration * 1000,
+                     "rows": query.rows} for query in profile.queries],
+    })
+
+    return response
+
+# Pages of logged in users show their name and forms with their CSRF token,
+# so only the client itself may keep them. Anonymous pages are public.
+@app.after_request
+def set_cache_control(response):
+    if request.method not in ("GET", "HEAD"):
+        return response
+
+    if request.endpoint == "static":
+        # a fingerprinted URL always has the same content, other static URLs
+        # keep the revalidation policy of Flask
+        filename = request.view_args["filename"]
+        if ("v" in request.args
+            and request.args["v"] == static_fingerprint(filename)):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = config.STATIC_MAX_AGE
+            response.cache_control.immutable = True
+    elif "Cache-Control" not in response.headers:
+        if "user_id" in session or session.modified:
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        else:
+            response.cache_control.public = True
+            response.cache_control.max_age = config.PAGE_MAX_AGE
+
+    return response
+
+# Compresses responses with brotli or gzip if the client accepts either.
+# Streamed responses are compressed while they are sent.
+@app.after_request
+def compress_response(response):
+    encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+    encoding = request.accept_encodings.best_match(encodings)
+
+    if (encoding is None or response.status_code != 200
+        or response.mimetype not in config.COMPRESS_MIMETYPES
+        or "Content-Encoding" in response.headers):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        # static files are sent from the file unless read here
+        response.direct_passthrough = False
+        data = response.get_data()
+
+        if len(data) < config.COMPRESS_MIN_SIZE:
+            return response
+
+        response.set_data(compress(data, encoding))
+
+    response.content_encoding = encoding
+
+    # the compressed body is no longer byte for byte the tagged one
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=config.BROTLI_QUALITY)
+
+    return gzip.compress(data, compresslevel=config.GZIP_LEVEL)
+
+def compress_stream(chunks, encoding):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=config.BROTLI_QUALITY)
+        process, finish = compressor.process, compressor.finish
+    else:
+        # 16 + 15 window bits writes the gzip header and trailer
+        compressor = zlib.compressobj(config.GZIP_LEVEL, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+
+            data = process(chunk)
+            if data:
+                yield data
+
+        yield finish()
+    finally:
+        # ends the request context kept by stream_with_context
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+@app.route("/debug/stats")
+def debug_stats():
+    if not config.DEBUG_ENDPOINTS:
+        abort(404)
+
+    return jsonify({
+        "pool": asdict(db.stats()),
+        "cache": asdict(cache.stats()),
+        "slow_queries": [asdict(query) for query in db.slow_queries],
+        "requests": list(request_timings),
+    })
+
+# How far the work done in the background is behind
+@app.route("/debug/queue")
+def debug_queue():
+    if not config.DEBUG_ENDPOINTS:
+        abort(404)
+
+    return jsonify(asdict(outbox.queue_stats()))
+
 def csrf_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -52,6 +318,92 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Caches pages shown to anonymous users by the URL and the content version.
+# Pages that also change without the content version changing, such as the
+# statistics of a user, give the validator of conditional_page(), and its ETag
+# is made part of the key too. Logged in users see their own name and
+# controls, and flashed messages are shown only once, so such pages are
+# always rendered.
+def cached_page(validator=None):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if "user_id" in session or "_flashes" in session:
+                return f(*args, **kwargs)
+
+            key = f"page:{get_content_version()}:{request.full_path}"
+
+            if validator is not None:
+                validators = validator(*args, **kwargs)
+                if validators is None:
+                    return f(*args, **kwargs)
+
+                key = f"{key}:{validators[0]}"
+
+            page = cache.get(key)
+
+            if page is None:
+                page = f(*args, **kwargs)
+
+                # redirects are not cached
+                if isinstance(page, str):
+                    cache.set(key, page)
+
+            return page
+        return decorated_function
+    return decorator
+
+# Answers 304 Not Modified to anonymous clients that already have the
+# current version of the page. The validator returns the ETag and the Unix
+# time the page was last modified for the arguments of the view, or None if
+# the view should handle the request itself.
+def conditional_page(validator):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if "user_id" in session or "_flashes" in session:
+                return f(*args, **kwargs)
+
+            validators = validator(*args, **kwargs)
+            if validators is None:
+                return f(*args, **kwargs)
+
+            etag, modified = validators
+            last_modified = (datetime.fromtimestamp(modified, timezone.utc)
+                             if modified else None)
+
+            if is_resource_modified(request.environ, etag=etag,
+                                    last_modified=last_modified):
+                response = make_response(f(*args, **kwargs))
+            else:
+                response = app.response_class(status=304)
+
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+
+            return response
+        return decorated_function
+    return decorator
+
+# The page of a program changes with the program version, and the page of a
+# user with the user version
+def program_page_validator(program_id):
+    try:
+        version, modified = get_program_version(program_id)
+    except ProgramNotFound:
+        return None
+
+    return f"p{program_id}-{version}", modified
+
+def user_page_validator(user_id):
+    try:
+        version, modified = get_user_version(user_id)
+    except UserNotFound:
+        return None
+
+    return f"u{user_id}-{version}", modified
+
 # Returns the zero-indexed page number from query parameters showing to the
 # user as one-indexed
 def get_page():
@@ -65,35 +417,93 @@ def get_page():
 
     return page
 
+# Returns the after and before cursors (program IDs) from query parameters,
+# None for missing or invalid ones
+def get_cursors():
+    return (request.args.get("after", type=int),
+            request.args.get("before", type=int))
+
+# Tells whether the listing is on its first page. The class values are only
+# counted there, as counting them takes as long as reading every page.
+def is_first_page(page, after, before):
+    return page == 0 and after is None and before is None
+
+# Returns the class value IDs to filter listings with from query parameters,
+# ignoring unknown values
+def get_filters():
+    known = get_class_catalogue().values
+    values = request.args.getlist("c", type=int)
+
+    return [value for value in dict.fromkeys(values) if value in known]
+
+# Returns the sort parameter of a sorted listing, None for the newest first
+# order and unknown values
+def get_sort():
+    sort = request.args.get("sort")
+    return sort if sort in RANKINGS else None
+
 @app.route("/")
+@cached_page()
 def index():
     page = get_page()
+    after, before = get_cursors()
+    filters = get_filters()
+    sort = get_sort()
 
-    listing = get_programs(page=page)
+    listing = get_programs(page=page, after=after, before=before,
+                           values=filters, sort=sort)
+    facets = get_facets(filters, counts=is_first_page(page, after, before))
 
-    prev_page = page if page > 0 else None
-    next_page = page + 2 if listing.has_more else None
+    prev_cursor, next_cursor = page_cursors(listing.programs,
+                                            listing.has_previous,
+                                            listing.has_more)
 
     return render_template("index.html", programs=listing.programs,
-                           next_page=next_page, prev_page=prev_page)
+                           next_cursor=next_cursor, prev_cursor=prev_cursor,
+                           facets=facets, filters=filters, sort=sort)
 
 @app.route("/search")
+@cached_page()
 def search():
     if "text" not in request.args:
         return redirect("/")
 
     page = get_page()
+    after, before = get_cursors()
     searchtext = request.args["text"]
-
-    listing = search_programs(searchtext, page=page)
-
-    prev_page = page if page > 0 else None
-    next_page = page + 2 if listing.has_more else None
-
+    ranked = request.args.get("sort") == "relevance"
+    filters = get_filters()
+
+    listing = search_programs(searchtext, page=page, after=after,
+                              before=before, ranked=ranked, values=filters)
+    facets = get_facets(filters, searchtext,
+                        counts=is_first_page(page, after, before))
+
+    if ranked:
+        # relevance order can only be paged with page numbers
+        prev_page = page if listing.has_previous else None
+        next_page = page + 2 if listing.has_more else None
+        prev_cursor, next_cursor = None, None
+    else:
+        prev_page, next_page = None, None
+        prev_cursor, next_cursor = page_cursors(listing.programs,
+                                                listing.has_previous,
+                                                listing.has_more)
 
     return render_template("search.html", programs=listing.programs,
+                           prev_cursor=prev_cursor, next_cursor=next_cursor,
                            prev_page=prev_page, next_page=next_page,
-                           searchtext=searchtext)
+                           searchtext=searchtext, ranked=ranked,
+                           facets=facets, filters=filters)
+
+# Logging in and registering compute a password hash, so they are limited to
+# keep guessing passwords from taking all of the CPU
+login_ip_limiter = RateLimiter(config.LOGIN_ATTEMPTS_PER_IP,
+                               config.RATE_LIMIT_PERIOD)
+login_username_limiter = RateLimiter(config.LOGIN_ATTEMPTS_PER_USERNAME,
+                                     config.RATE_LIMIT_PERIOD)
+register_ip_limiter = RateLimiter(config.REGISTRATIONS_PER_IP,
+                                  config.RATE_LIMIT_PERIOD)
 
 @app.route("/login")
 def login_page():
@@ -104,11 +514,20 @@ def login_form():
     username = request.form["username"]
     password = request.form["password"]
 
+    if (not login_ip_limiter.hit(request.remote_addr)
+        or not login_username_limiter.hit(username.lower())):
+        flash("Virhe: liian monta kirjautumisyritystä, yritä myöhemmin "
+              "uudelleen")
+        return render_template("login.html", username=username), 429
+
     try:
         user_id = login(username, password)
     except WrongCredentials:
         flash("Virhe: väärä tunnus tai salasana")
         return render_template("login.html", username=username)
+    except HashQueueFull:
+        flash("Virhe: palvelu on ruuhkautunut, yritä hetken päästä uudelleen")
+        return render_template("login.html", username=username), 503
 
     session["username"] = username
     session["user_id"] = user_id
@@ -133,11 +552,19 @@ def register():
         or len(password1) > 128):
         abort(400)
 
+    if not register_ip_limiter.hit(request.remote_addr):
+        flash("Virhe: liian monta rekisteröitymistä, yritä myöhemmin "
+              "uudelleen")
+        return render_template("register.html", username=username), 429
+
     try:
         create_user(username, password1)
     except UserExists:
         flash("Virhe: tunnus on jo varattu")
         return redirect("/register")
+    except HashQueueFull:
+        flash("Virhe: palvelu on ruuhkautunut, yritä hetken päästä uudelleen")
+        return render_template("register.html", username=username), 503
 
     flash("Tunnus luotu")
     return redirect("/login")
@@ -179,14 +606,14 @@ def create():
         or len(description) > 5000):
         abort(400)
 
-    classes = get_classes()
-
     values = []
-    for clas in classes:
-        options = [str(opt.id) for opt in clas.options]
-        value = request.form[f"class{clas.id}"]
+    for clas in get_classes():
+        try:
+            value = int(request.form[f"class{clas.id}"])
+        except ValueError:
+            abort(400)
 
-        if value not in options:
+        if value not in clas.option_ids:
             abort(400)
 
         values.append(value)
@@ -201,18 +628,25 @@ def create():
     return redirect(f"/p/{program_id}")
 
 @app.route("/p/<int:program_id>")
+@conditional_page(program_page_validator)
 def program_page(program_id):
-    try:
-        program = get_program(program_id)
-    except ProgramNotFound:
-        flash("Sovellusta ei löytynyt")
-        abort(404)
+    before = request.args.get("reviews_before", type=int)
 
-    reviews = get_reviews(program_id)
-    can_review = "user_id" in session
+    # the reviews are read while the template is rendered, so the whole page
+    # is rendered from the same snapshot of the database
+    with db.transaction(write=False):
+        try:
+            program = get_program(program_id)
+        except ProgramNotFound:
+            flash("Sovellusta ei löytynyt")
+            abort(404)
 
-    return render_template("program.html", program=program,
-                           can_review=can_review, reviews=reviews)
+        reviews = get_reviews(program_id, before=before)
+        can_review = "user_id" in session
+
+        return render_template("program.html", program=program,
+                               can_review=can_review, reviews=reviews,
+                               newer_reviews=before is not None)
 
 @app.route("/p/<int:program_id>/edit")
 @login_required
@@ -293,38 +727,265 @@ def review(program_id):
         review_program(program_id, session["user_id"], grade, comment)
     except ReviewedAlready:
         flash("Virhe: olet jo lisännyt arvostelun")
+    except ProgramNotFound:
+        abort(404)
 
     return redirect(f"/p/{program_id}")
 
 @app.route("/u/<int:user_id>")
+@conditional_page(user_page_validator)
+@cached_page(user_page_validator)
 def user_page(user_id):
     page = get_page()
+    after, before = get_cursors()
 
     try:
         stats = user_stats(user_id)
-        programs = user_programs(user_id, page=page)
+        programs = user_programs(user_id, page=page, after=after,
+                                 before=before)
     except UserNotFound:
         abort(404)
 
-    prev_page = page if page > 0 else None
-    next_page = page + 2 if programs.has_more else None
+    prev_cursor, next_cursor = page_cursors(programs.programs,
+                                            programs.has_previous,
+                                            programs.has_more)
 
     return render_template("user.html", name=stats.name, stats=stats,
-                           programs=programs.programs, next_page=next_page,
-                           prev_page=prev_page, user_id=user_id)
+                           programs=programs.programs, next_cursor=next_cursor,
+                           prev_cursor=prev_cursor, user_id=user_id)
+
+# Read-only JSON API. Every response is tagged with the content version, so
+# a client sending the tag back in If-None-Match gets 304 Not Modified
+# without anything else being read from the database.
+def api_response(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        etag = f"v{get_content_version()}"
+
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            response = make_response(f(*args, **kwargs))
+
+        response.set_etag(etag, weak=True)
+        return response
+    return decorated_function
+
+def api_not_found(message):
+    abort(make_response(jsonify({"error": message}), 404))
+
+# Returns a page of programs with the cursors of the neighbouring pages
+def listing_json(programs, has_previous, has_more):
+    prev_cursor, next_cursor = page_cursors(programs, has_previous, has_more)
+
+    return {
+        "programs": [asdict(program) for program in programs],
+        "prev_cursor": prev_cursor,
+        "next_cursor": next_cursor,
+    }
+
+@app.route("/api/programs")
+@api_response
+def api_programs():
+    after, before = get_cursors()
+    listing = get_programs(after=after, before=before, values=get_filters(),
+                           sort=get_sort())
+
+    return jsonify(listing_json(listing.programs, listing.has_previous,
+                                listing.has_more))
+
+# All programs as newline delimited JSON, one program per line. The programs
+# are streamed from the database cursor, so the export never has all of them
+# in memory.
+@app.route("/api/programs/export")
+@api_response
+def api_export_programs():
+    def generate():
+        lines = []
+
+        with db.transaction(write=False):
+            for program in iterate_programs():
+                # the fields are read directly from the slots, asdict() would
+                # copy every value and take most of the time of the export
+                row = {name: getattr(program, name)
+                       for name in program.__slots__}
+                lines.append(json.dumps(row, ensure_ascii=False))
+
+                if len(lines) == config.DB_FETCH_SIZE:
+                    yield "\n".join(lines) + "\n"
+                    lines = []
+
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+    return app.response_class(stream_with_context(generate()),
+                              mimetype="application/x-ndjson")
+
+@app.route("/api/programs/<int:program_id>")
+@api_response
+def api_program(program_id):
+    try:
+        program = get_program(program_id)
+    except ProgramNotFound:
+        api_not_found("program not found")
+
+    return jsonify(asdict(program))
+
+@app.route("/api/programs/<int:program_id>/reviews")
+@api_response
+def api_reviews(program_id):
+    before = request.args.get("before", type=int)
+
+    with db.transaction(write=False):
+        if not db.query("SELECT 1 FROM programs WHERE id = ?", [program_id]):
+            api_not_found("program not found")
+
+        reviews = get_reviews(program_id, before=before)
+        result = [asdict(review) for review in reviews]
+
+    return jsonify({"reviews": result, "next_cursor": reviews.next_before})
+
+@app.route("/api/users/<int:user_id>")
+@api_response
+def api_user(user_id):
+    after, before = get_cursors()
+
+    try:
+        with db.transaction(write=False):
+            stats = user_stats(user_id)
+            programs = user_programs(user_id, after=after, before=before)
+    except UserNotFound:
+        api_not_found("user not found")
+
+    result = listing_json(programs.programs, programs.has_previous,
+                          programs.has_more)
+    result["user"] = {"id": user_id, **asdict(stats)}
+
+    return jsonify(result)
+
+@app.route("/api/search")
+@api_response
+def api_search():
+    if "text" not in request.args:
+        abort(make_response(jsonify({"error": "text is required"}), 400))
 
+    page = get_page()
+    after, before = get_cursors()
+    ranked = request.args.get("sort") == "relevance"
+
+    listing = search_programs(request.args["text"], page=page, after=after,
+                              before=before, ranked=ranked,
+                              values=get_filters())
+
+    if ranked:
+        # relevance order can only be paged with one-indexed page numbers
+        return jsonify({
+            "programs": [asdict(program) for program in listing.programs],
+            "prev_page": page if listing.has_previous else None,
+            "next_page": page + 2 if listing.has_more else None,
+        })
+
+    return jsonify(listing_json(listing.programs, listing.has_previous,
+                                listing.has_more))
+
+# static file name -> (modification time, fingerprint)
+static_fingerprints = {}
+
+# Returns a hash of the content of a static file, recomputed only when the
+# file changes
+def static_fingerprint(filename):
+    path = safe_join(app.static_folder, filename)
+
+    try:
+        mtime = os.path.getmtime(path)
+    except (OSError, TypeError):
+        # missing or outside of the static folder
+        return None
+
+    cached = static_fingerprints.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, "rb") as f:
+        fingerprint = hashlib.sha256(f.read()).hexdigest()[:16]
+
+    static_fingerprints[filename] = (mtime, fingerprint)
+    return fingerprint
+
+# URL of a static file with its fingerprint, so that it can be cached for as
+# long as the file stays the same
+@app.template_global()
+def static_url(filename):
+    return url_for("static", filename=filename,
+                   v=static_fingerprint(filename))
+
+# Renders the card of a program in listings, cached by the program version
+@app.template_global()
+def program_card(program):
+    key = f"card:{program.id}:{program.version}"
+    card = cache.get(key)
+
+    if card is None:
+        card = render_template("programcard.html", program=program)
+        cache.set(key, card)
+
+    return markupsafe.Markup(card)
+
+# Rendered descriptions by program ID and version, so that the text of a
+# program is converted only once per version
+lines_cache = MemoryCache(config.CACHE_MAX_ITEMS)
+
+# Escapes the text and turns every run of line breaks into a paragraph break
 @app.template_filter()
-def show_lines(content):
-    content = str(markupsafe.escape(content))
-    content = content.replace("\r", "")
+def show_lines(content, key=None):
+    if key is not None:
+        cached = lines_cache.get(key)
 
-    while "\n\n" in content:
-        content = content.replace("\n\n", "\n")
+        if cached is not None:
+            return markupsafe.Markup(cached)
 
-    content = content.replace("\n", "</p><p>")
+    content = str(markupsafe.escape(content)).replace("\r", "")
+    content = LINE_BREAKS.sub("\n", content).replace("\n", "</p><p>")
     content = "<p>" + content + "</p>"
+
+    if key is not None:
+        lines_cache.set(key, content)
+
     return markupsafe.Markup(content)
 
 @app.template_filter("roundf")
 def roundf_filter(content, digits):
     return round(float(content), ndigits=digits)
+
+@app.cli.command("rebuild-aggregates")
+def rebuild_aggregates_command():
+    db.rebuild_aggregates()
+
+@app.cli.command("optimize")
+def optimize_command():
+    db.optimize()
+
+# Replaces the replicas of DB_REPLICAS with copies of the database, run
+# periodically to keep them up to date
+@app.cli.command("snapshot-replicas")
+def snapshot_replicas_command():
+    for replica in config.DB_REPLICAS:
+        db.snapshot_replica(replica)
+
+# Handles the events of the outbox until stopped, for running the workers in
+# a process of their own with OUTBOX_WORKERS = 0
+@app.cli.command("process-outbox")
+def process_outbox_command():
+    outbox.work()
+
+# Updates the sorted listings, run every few minutes and with --full every
+# now and then to also update the mean grade
+@app.cli.command("refresh-rankings")
+@click.option("--full", is_flag=True,
+              help="Refresh all programs instead of the changed ones.")
+def refresh_rankings_command(full):
+    refresh_rankings(full)
+
+@app.cli.command("rebuild-search")
+def rebuild_search_command():
+    db.rebuild_search_index()
@@ -0,0 +1,193 @@
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from app import app, create_app
+
+
+# Serves the Flask application to an ASGI server. Reading the request and
+# sending the response happen on the event loop, and only running the
+# application takes one of a fixed number of threads, so slow clients do not
+# hold a thread each. Every request runs, including its streamed response,
+# in a single thread, as the database connection of a request belongs to the
+# thread it was checked out by.
+class AsgiApp:
+    def __init__(self, wsgi_app, workers=config.ASGI_WORKERS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(workers,
+                                           thread_name_prefix="asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            message = await receive()
+
+            if message["type"] == "lifespan.startup":
+                await loop.run_in_executor(self.executor, create_app)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = await read_body(receive)
+
+        if body is None:
+            await send({"type": "http.response.start", "status": 413,
+                        "headers": [(b"content-length", b"0")]})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        loop = asyncio.get_running_loop()
+        # a few chunks of a streamed response are buffered ahead of the
+        # client, after that the thread waits for the client to catch up
+        messages = asyncio.Queue(maxsize=config.ASGI_BUFFERED_CHUNKS)
+        cancelled = threading.Event()
+        done = loop.run_in_executor(self.executor, self._run, scope, body,
+                                    loop, messages, cancelled)
+
+        try:
+            while (message := await messages.get()) is not None:
+                await send(message)
+        except BaseException:
+            # the client went away, the thread stops at its next chunk
+            cancelled.set()
+
+            while await messages.get() is not None:
+                pass
+
+            raise
+        finally:
+            await done
+
+    # Runs the application in a worker thread and passes the response to the
+    # event loop one message at a time
+    def _run(self, scope, body, loop, messages, cancelled):
+        def put(message):
+            asyncio.run_coroutine_threadsafe(messages.put(message),
+                                             loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [(name.lower().encode("latin-1"),
+                                    value.encode("latin-1"))
+                                   for name, value in headers]
+
+        started = False
+
+        try:
+            result = self.wsgi_app(environ(scope, body), start_response)
+
+            try:
+                for chunk in result:
+                    if cancelled.is_set():
+                        break
+
+                    if not started:
+                        put({"type": "http.response.start",
+                             "status": response["status"],
+                             "headers": response["headers"]})
+                        started = True
+
+                    if chunk:
+                        put({"type": "http.response.body", "body": chunk,
+                             "more_body": True})
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+
+            if not cancelled.is_set():
+                if not started:
+                    put({"type": "http.response.start",
+                         "status": response["status"],
+                         "headers": response["headers"]})
+
+                put({"type": "http.response.body", "body": b"",
+                     "more_body": False})
+        finally:
+            put(None)
+
+# Returns the whole body of the request, None if it is larger than
+# ASGI_MAX_BODY bytes
+async def read_body(receive):
+    body = bytearray()
+
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+
+        if len(body) > config.ASGI_MAX_BODY:
+            return None
+
+        if not message.get("more_body", False):
+            return bytes(body)
+
+# Returns the WSGI environment of an ASGI HTTP request
+def environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+
+    env = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8")
+                                                .decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            key = name
+        else:
+            key = "HTTP_" + name
+
+        # repeated headers are combined as one, HTTP/2 clients send every
+        # cookie in a header of its own
+        separator = "; " if key == "HTTP_COOKIE" else ","
+        env[key] = env[key] + separator + value if key in env else value
+
+    # the body has already been read whole, also if it was sent in chunks
+    env.pop("HTTP_TRANSFER_ENCODING", None)
+    env["CONTENT_LENGTH"] = str(len(body))
+
+    return env
+
+application = AsgiApp(app)
+
+if __name__ == "__main__":
+    try:
+        import uvicorn
+    except ImportError:
+        print("Asenna uvicorn (pip install uvicorn) tai käynnistä jollain "
+              "muulla ASGI-palvelimella: asgi:application")
+        sys.exit(1)
+
+    uvicorn.run("asgi:application", host="127.0.0.1", port=5000)
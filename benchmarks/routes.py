@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import random
+import secrets
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+# the benchmarks are run from the repository root as scripts
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import config
+import seed
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Measures the latency and throughput of every route "
+                    "against a seeded database.")
+    parser.add_argument("--database", default="benchmark.db",
+                        help="seeded database, created if it does not exist "
+                             "(default: %(default)s)")
+    parser.add_argument("--users", type=int, default=1000,
+                        help="users to seed (default: %(default)s)")
+    parser.add_argument("--max-programs", type=int, default=200)
+    parser.add_argument("--max-reviews", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per scenario and concurrency level "
+                             "(default: %(default)s)")
+    parser.add_argument("--concurrency", default="1,4",
+                        help="comma separated numbers of concurrent clients "
+                             "(default: %(default)s)")
+    parser.add_argument("--scenarios",
+                        help="comma separated scenario names, all by default")
+    parser.add_argument("--cache", action="store_true",
+                        help="keep the configured render cache enabled")
+    parser.add_argument("--output", help="write the results as JSON here")
+    parser.add_argument("--compare",
+                        help="JSON results of an earlier run to compare with")
+    return parser.parse_args(args)
+
+# Returns the id of the program at the given depth of the front page order
+def program_at(db, depth):
+    sql = "SELECT id FROM programs ORDER BY id DESC LIMIT 1 OFFSET ?"
+    res = db.query(sql, [depth])
+    return res[0][0] if res else 1
+
+# Returns a dict from scenario names to functions giving the next URL, or the
+# URL and the form for POST requests
+def scenarios(db):
+    from program import get_classes
+
+    program_count = db.query("SELECT COUNT(*) FROM programs")[0][0]
+    user_count = db.query("SELECT COUNT(*) FROM users")[0][0]
+    last_page = max(program_count // config.ITEMS_PER_PAGE, 1)
+    deep = program_at(db, program_count - config.ITEMS_PER_PAGE)
+    middle = program_at(db, program_count // 2)
+
+    sql = """SELECT MIN(rowid) FROM (SELECT rowid FROM programs_fts
+             WHERE programs_fts MATCH 'linux*' ORDER BY rowid DESC
+             LIMIT 1000000)""" if db.has_fts5 else "SELECT 1"
+    search_deep = db.query(sql)[0][0] or 1
+
+    sql = """SELECT author FROM programs GROUP BY author
+             ORDER BY COUNT(*) DESC LIMIT 1"""
+    busiest_user = db.query(sql)[0][0]
+    busiest_last = db.query("SELECT MAX(id) FROM programs WHERE author = ?",
+                            [busiest_user])[0][0]
+
+    names = iter(range(10 ** 9))
+    # a program needs a value for every class
+    class_values = {f"class{clas.id}": str(clas.options[0].id)
+                    for clas in get_classes()}
+
+    def review():
+        program_id = random.randint(1, program_count)
+        return f"/p/{program_id}/review", {"grade": "4", "comment": "ok"}
+
+    def create():
+        return "/create", {"name": f"benchmark {time.time_ns()} {next(names)}",
+                           "source_link": "https://example.com",
+                           "download_link": "https://example.com",
+                           "description": "ohjelma\n\nbenchmark",
+                           **class_values}
+
+    return {
+        "index": lambda: "/",
+        "index_offset_middle": lambda: f"/?p={last_page // 2}",
+        "index_offset_last": lambda: f"/?p={last_page}",
+        "index_cursor_middle": lambda: f"/?after={middle}",
+        "index_cursor_last": lambda: f"/?after={deep}",
+        "index_filtered": lambda: "/?c=1&c=14",
+        "search": lambda: "/search?text=linux",
+        "search_cursor_deep": lambda: f"/search?text=linux&after={search_deep}",
+        "search_relevance": lambda: "/search?text=linux&sort=relevance",
+        "program": lambda: f"/p/{random.randint(1, program_count)}",
+        "user": lambda: f"/u/{random.randint(1, user_count)}",
+        "user_busiest_last": lambda: f"/u/{busiest_user}?before={busiest_last + 1}",
+        "review": review,
+        "create": create,
+    }
+
+def login(client, user_count):
+    user_id = random.randint(1, user_count)
+    csrf_token = secrets.token_hex(16)
+
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+        session["username"] = "käyttäjä" + str(user_id)
+        session["csrf_token"] = csrf_token
+
+    return csrf_token
+
+def run_scenario(app, next_request, requests, concurrency, user_count):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_client = max(requests // concurrency, 1)
+
+    def client_loop():
+        client = app.test_client()
+        csrf_token = login(client, user_count)
+        own = []
+
+        for _ in range(per_client):
+            target = next_request()
+            start = time.perf_counter()
+
+            if isinstance(target, tuple):
+                url, form = target
+                response = client.post(url, data={**form,
+                                                  "csrf_token": csrf_token})
+                # a handled form redirects to the program, anything else
+                # means the form was refused
+                ok = (response.status_code == 302
+                      and response.location.startswith("/p/"))
+            else:
+                response = client.get(target)
+                ok = response.status_code == 200
+
+            own.append(time.perf_counter() - start)
+
+            if not ok:
+                errors.append(response.status_code)
+
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=client_loop)
+               for _ in range(concurrency)]
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput": len(latencies) / elapsed,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "p50_ms": quantiles[49] * 1000,
+        "p95_ms": quantiles[94] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, baseline):
+    print(f"{'scenario':<22} {'c':>3} {'req/s':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+
+    for key, result in results.items():
+        line = (f"{result['scenario']:<22} {result['concurrency']:>3} "
+                f"{result['throughput']:>8.1f} {result['p50_ms']:>8.2f} "
+                f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+                f"{result['errors']:>6}")
+
+        if baseline is not None and key in baseline:
+            before = baseline[key]["p50_ms"]
+            line += f"  p50 {(result['p50_ms'] - before) / before * 100:+.0f}%"
+
+        print(line)
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    if not os.path.exists(args.database):
+        seed.seed(args.database, args.users, args.max_programs,
+                  args.max_reviews, args.seed)
+
+    config.DATABASE_FILE = args.database
+
+    if not args.cache:
+        config.CACHE_BACKEND = None
+
+    from app import app
+    from db import db
+
+    app.testing = True
+
+    user_count = db.query("SELECT COUNT(*) FROM users")[0][0]
+    all_scenarios = scenarios(db)
+    db.release()
+
+    names = (args.scenarios.split(",") if args.scenarios
+             else list(all_scenarios))
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    results = {}
+    for name in names:
+        for concurrency in levels:
+            result = run_scenario(app, all_scenarios[name], args.requests,
+                                  concurrency, user_count)
+            result["scenario"] = name
+            result["concurrency"] = concurrency
+            results[f"{name}@{concurrency}"] = result
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    print_results(results, baseline)
+
+    if args.output:
+        report = {
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "database": {
+                "users": user_count,
+                "programs": db.query("SELECT COUNT(*) FROM programs")[0][0],
+                "reviews": db.query("SELECT COUNT(*) FROM reviews")[0][0],
+            },
+            "results": results,
+        }
+
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
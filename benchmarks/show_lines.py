@@ -0,0 +1,58 @@
+import os
+import sys
+import tempfile
+import timeit
+
+import markupsafe
+
+# the benchmarks are run from the repository root as scripts
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import config
+
+config.DATABASE_FILE = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+
+from app import lines_cache, show_lines
+
+
+# the filter before it was made linear
+def old_show_lines(content):
+    content = str(markupsafe.escape(content))
+    content = content.replace("\r", "")
+
+    while "\n\n" in content:
+        content = content.replace("\n\n", "\n")
+
+    content = content.replace("\n", "</p><p>")
+    content = "<p>" + content + "</p>"
+    return markupsafe.Markup(content)
+
+# the longest description and comment allowed by the forms
+CASES = {
+    "description": ("ehkä paras projektini ikinä.\n\n" * 200)[:5000],
+    "only line breaks": "\r\n" * 2500,
+    "one long gap": "a" + "\n" * 4998 + "b",
+    "comment": ("ihan hyvä ohjelma.\n\n\n" * 100)[:2000],
+}
+
+def main():
+    print(f"{'case':<20} {'old':>10} {'new':>10} {'memoized':>10}  (µs/call)")
+
+    for name, text in CASES.items():
+        assert old_show_lines(text) == show_lines(text)
+
+        runs = 200
+        old = timeit.timeit(lambda: old_show_lines(text), number=runs)
+        new = timeit.timeit(lambda: show_lines(text), number=runs)
+
+        lines_cache.set("benchmark", str(show_lines(text)))
+        memoized = timeit.timeit(lambda: show_lines(text, "benchmark"),
+                                 number=runs)
+
+        print(f"{name:<20} {old / runs * 1e6:>10.1f} {new / runs * 1e6:>10.1f} "
+              f"{memoized / runs * 1e6:>10.1f}")
+
+if __name__ == "__main__":
+    main()
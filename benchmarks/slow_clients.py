@@ -0,0 +1,167 @@
+import argparse
+import asyncio
+import io
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# the benchmarks are run from the repository root as scripts
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import config
+import seed
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Compares the WSGI and ASGI modes with many concurrent "
+                    "clients on slow connections. The network is simulated "
+                    "in the process: every request takes --delay "
+                    "milliseconds to arrive and its response as long to be "
+                    "sent.")
+    parser.add_argument("--database", default="benchmark.db",
+                        help="seeded database, created if it does not exist "
+                             "(default: %(default)s)")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--clients", type=int, default=64,
+                        help="concurrent clients (default: %(default)s)")
+    parser.add_argument("--requests", type=int, default=10,
+                        help="requests per client (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=config.ASGI_WORKERS,
+                        help="WSGI worker threads and ASGI application "
+                             "threads (default: %(default)s)")
+    parser.add_argument("--delay", type=float, default=100,
+                        help="milliseconds the request and the response each "
+                             "spend on the network (default: %(default)s)")
+    return parser.parse_args(args)
+
+def environ(path):
+    return {
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": "127.0.0.1",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+
+# A threaded WSGI server with a fixed number of threads, like gunicorn with
+# --threads: a thread serves one connection at a time from the request to the
+# last byte of the response
+def run_wsgi(app, paths, args):
+    delay = args.delay / 1000
+    latencies = []
+
+    def serve(path):
+        time.sleep(delay)
+
+        result = app(environ(path), lambda status, headers, exc_info=None: None)
+        try:
+            for _ in result:
+                pass
+        finally:
+            result.close()
+
+        time.sleep(delay)
+
+    # a client waits for a free server thread before its request is read
+    def client(server, own):
+        for path in own:
+            start = time.perf_counter()
+            server.submit(serve, path).result()
+            latencies.append(time.perf_counter() - start)
+
+    per_client = [paths[i::args.clients] for i in range(args.clients)]
+
+    with ThreadPoolExecutor(args.workers) as server:
+        with ThreadPoolExecutor(args.clients) as clients:
+            start = time.perf_counter()
+            list(clients.map(lambda own: client(server, own), per_client))
+
+    return time.perf_counter() - start, latencies
+
+def run_asgi(application, paths, args):
+    delay = args.delay / 1000
+    latencies = []
+
+    async def request(path):
+        start = time.perf_counter()
+
+        async def receive():
+            await asyncio.sleep(delay)
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if (message["type"] == "http.response.body"
+                and not message.get("more_body", False)):
+                await asyncio.sleep(delay)
+
+        scope = {"type": "http", "method": "GET", "path": path,
+                 "query_string": b"", "headers": [], "http_version": "1.1",
+                 "scheme": "http", "server": ("localhost", 80),
+                 "client": ("127.0.0.1", 0)}
+        await application(scope, receive, send)
+        latencies.append(time.perf_counter() - start)
+
+    async def client(own):
+        for path in own:
+            await request(path)
+
+    async def main():
+        per_client = [paths[i::args.clients] for i in range(args.clients)]
+        await asyncio.gather(*(client(own) for own in per_client))
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    return time.perf_counter() - start, latencies
+
+def report(name, elapsed, latencies):
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    print(f"{name:<6} {len(latencies) / elapsed:>8.1f} "
+          f"{quantiles[49] * 1000:>8.1f} {quantiles[94] * 1000:>8.1f} "
+          f"{quantiles[98] * 1000:>8.1f}")
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    if not os.path.exists(args.database):
+        seed.seed(args.database, args.users, 200, 400, 0)
+
+    config.DATABASE_FILE = args.database
+    config.CACHE_BACKEND = None
+
+    from app import app, create_app
+    from asgi import AsgiApp
+    from db import db
+
+    create_app()
+    program_count = db.query("SELECT MAX(id) FROM programs")[0][0]
+    db.release()
+
+    paths = [f"/p/{random.randint(1, program_count)}"
+             for _ in range(args.clients * args.requests)]
+
+    print(f"{args.clients} clients, {args.workers} threads, "
+          f"{args.delay:.0f} ms each way")
+    print(f"{'mode':<6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8}")
+
+    report("wsgi", *run_wsgi(app, paths, args))
+    report("asgi", *run_asgi(AsgiApp(app, args.workers), paths, args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# the benchmarks are run from the repository root as scripts
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+# run in a new interpreter for every measurement, so nothing is imported yet
+CHILD = """
+import time
+start = time.perf_counter()
+
+import config
+config.DATABASE_FILE = {database!r}
+
+import app
+imported = time.perf_counter()
+
+app.create_app()
+opened = time.perf_counter()
+
+client = app.app.test_client()
+client.get("/")
+served = time.perf_counter()
+
+print((imported - start) * 1000, (opened - imported) * 1000,
+      (served - opened) * 1000)
+"""
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Measures how long a new process takes to import the "
+                    "application, open the database and serve its first "
+                    "request.")
+    parser.add_argument("--database", default="benchmark.db",
+                        help="database to open, seed it with "
+                             "benchmarks/routes.py or seed.py first "
+                             "(default: %(default)s)")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="processes to start (default: %(default)s)")
+    parser.add_argument("--output", help="write the results as JSON here")
+    return parser.parse_args(args)
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    if not os.path.exists(args.database):
+        print(f"{args.database} does not exist")
+        sys.exit(1)
+
+    script = CHILD.format(database=args.database)
+    runs = {"process_ms": [], "import_ms": [], "open_ms": [],
+            "first_request_ms": []}
+
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", script],
+                                capture_output=True, text=True,
+                                check=True).stdout
+        runs["process_ms"].append((time.perf_counter() - start) * 1000)
+
+        imported, opened, served = (float(x) for x in output.split()[-3:])
+        runs["import_ms"].append(imported)
+        runs["open_ms"].append(opened)
+        runs["first_request_ms"].append(served)
+
+    print(f"{'':<18} {'median':>8} {'min':>8} {'max':>8}  (ms)")
+
+    results = {}
+    for name, values in runs.items():
+        results[name] = {"median": statistics.median(values),
+                         "min": min(values), "max": max(values)}
+        print(f"{name:<18} {results[name]['median']:>8.1f} "
+              f"{results[name]['min']:>8.1f} {results[name]['max']:>8.1f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import config
+
+
+# Cache for rendered HTML. Keys contain the versions of the data they were
+# rendered from, so entries never have to be invalidated, only evicted.
+class Cache:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self._get(key)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value
+
+    def set(self, key, value):
+        self._set(key, value)
+
+    def stats(self):
+        return CacheStats(type(self).__name__, self.hits, self.misses)
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value):
+        raise NotImplementedError
+
+# Least recently used entries of the process
+class MemoryCache(Cache):
+    def __init__(self, max_items):
+        super().__init__()
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+
+            if value is not None:
+                self._items.move_to_end(key)
+
+            return value
+
+    def _set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+# Files in a directory shared by all processes of the host. Entries older
+# than ttl seconds are treated as missing and removed. Every max_items / 10
+# writes the directory is swept of expired entries and of the least recently
+# written ones over max_items, as the keys contain versions and the entries
+# of old versions are never read again.
+class FileCache(Cache):
+    def __init__(self, directory, ttl, max_items):
+        super().__init__()
+        self.directory = directory
+        self.ttl = ttl
+        self.max_items = max_items
+        self._writes = 0
+        self._sweep_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _get(self, key):
+        path = self._path(key)
+
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                self._remove(path)
+                return None
+
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _set(self, key, value):
+        path = self._path(key)
+        # written to a temporary file first so that readers never see a
+        # partially written entry
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+
+        with open(temp, "w", encoding="utf-8") as f:
+            f.write(value)
+
+        os.replace(temp, path)
+
+        with self._sweep_lock:
+            self._writes += 1
+            sweep = self._writes >= max(self.max_items // 10, 1)
+
+            if sweep:
+                self._writes = 0
+
+        if sweep:
+            self.sweep()
+
+    # Removes the expired entries and the oldest entries over max_items.
+    # Other processes may be sweeping at the same time, so files can vanish
+    # at any point.
+    def sweep(self):
+        now = time.time()
+        entries = []
+
+        with os.scandir(self.directory) as files:
+            for entry in files:
+                try:
+                    modified = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+
+                # temporary files of writers that stopped halfway too
+                if now - modified > self.ttl:
+                    self._remove(entry.path)
+                elif "." not in entry.name:
+                    entries.append((modified, entry.path))
+
+        entries.sort()
+
+        for _, path in entries[:max(len(entries) - self.max_items, 0)]:
+            self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+# Any server speaking the Redis protocol, needs the redis package
+class RedisCache(Cache):
+    def __init__(self, url, ttl):
+        super().__init__()
+
+        import redis
+
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url)
+
+    def _get(self, key):
+        value = self._client.get(key)
+        return value.decode("utf-8") if value is not None else None
+
+    def _set(self, key, value):
+        self._client.set(key, value.encode("utf-8"), ex=self.ttl)
+
+# Never stores anything, used when caching is disabled
+class NullCache(Cache):
+    def _get(self, key):
+        return None
+
+    def _set(self, key, value):
+        pass
+
+@dataclass
+class CacheStats:
+    backend: str
+    hits: int
+    misses: int
+
+def create_cache(backend):
+    if backend == "memory":
+        return MemoryCache(config.CACHE_MAX_ITEMS)
+    if backend == "file":
+        return FileCache(config.CACHE_DIRECTORY, config.CACHE_TTL,
+                         config.CACHE_MAX_ITEMS)
+    if backend == "redis":
+        return RedisCache(config.CACHE_REDIS_URL, config.CACHE_TTL)
+    if backend is None:
+        return NullCache()
+
+    raise ValueError(f"unknown cache backend {backend}")
+
+cache = create_cache(config.CACHE_BACKEND)
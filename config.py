@@ -2,3 +2,110 @@ SECRET_KEY = "2d0428696ca1cfc52c25ab54228c171f"
 DATABASE_FILE = "database.db"
 RESET_DB = False
 ITEMS_PER_PAGE = 20
+# the class value counts of searches and filtered listings only count this
+# many of the matching programs and are shown as "n+" when there are more
+FACET_COUNT_LIMIT = 10000
+DB_POOL_SIZE = 8
+# seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = 10
+DB_JOURNAL_MODE = "WAL"
+DB_SYNCHRONOUS = "NORMAL"
+# milliseconds SQLite itself waits on a locked database
+DB_BUSY_TIMEOUT = 5000
+DB_MMAP_SIZE = 256 * 1024 * 1024
+# negative values are in kibibytes
+DB_CACHE_SIZE = -16000
+# rows of every index sampled by ANALYZE, 0 reads all of them
+DB_ANALYSIS_LIMIT = 1000
+# read-only copies of the database that pages are read from, updated with
+# flask snapshot-replicas
+DB_REPLICAS = []
+# replicas are only replaced as a whole, so they are opened without locking
+DB_REPLICA_IMMUTABLE = True
+# how many times a write is retried after SQLITE_BUSY and the initial delay
+# in seconds, doubled after every attempt
+DB_WRITE_RETRIES = 5
+DB_WRITE_BACKOFF = 0.05
+# seconds the class catalogue is cached for, None caches it until
+# program.invalidate_classes() is called
+CLASS_CACHE_TTL = None
+# where rendered program cards and pages for anonymous users are cached:
+# "memory", "file", "redis" or None to disable caching
+CACHE_BACKEND = "memory"
+# entries kept by the memory and file caches
+CACHE_MAX_ITEMS = 10000
+CACHE_DIRECTORY = "cache"
+CACHE_REDIS_URL = "redis://localhost:6379/0"
+# seconds entries are kept in the file and Redis caches
+CACHE_TTL = 3600
+# statements slower than this many milliseconds are logged
+SLOW_QUERY_MS = 100
+SLOW_QUERY_LOG_SIZE = 100
+# log the query plan of slow queries too
+EXPLAIN_SLOW_QUERIES = False
+# records the database and template time of every request for /debug/stats,
+# and adds them to the responses in a Server-Timing header if DEBUG_ENDPOINTS
+# is also enabled
+PROFILE_REQUESTS = False
+# serves per-request timings, slow queries and pool and cache statistics at
+# /debug/stats, never enable in production
+DEBUG_ENDPOINTS = False
+# rows read from SQLite at a time when results are streamed
+DB_FETCH_SIZE = 100
+REVIEWS_PER_PAGE = 20
+# seconds browsers and shared caches may use a page for anonymous users
+# without asking again, pages of logged in users are never shared
+PAGE_MAX_AGE = 0
+# seconds static files linked with a fingerprint in the URL are cached
+STATIC_MAX_AGE = 365 * 24 * 3600
+# responses smaller than this many bytes are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MIMETYPES = {"text/html", "text/css", "text/plain", "text/javascript",
+                      "application/json", "application/x-ndjson"}
+GZIP_LEVEL = 6
+# brotli is used when the brotli package is installed and the client accepts
+# it, the highest qualities are too slow for responses compressed per request
+BROTLI_QUALITY = 5
+# threads running requests in the ASGI mode (asgi.py), at most DB_POOL_SIZE
+# so that every one of them gets a database connection without waiting
+ASGI_WORKERS = DB_POOL_SIZE
+# larger request bodies are refused with 413
+ASGI_MAX_BODY = 1024 * 1024
+# chunks of a streamed response buffered ahead of a slow client
+ASGI_BUFFERED_CHUNKS = 16
+# threads of every process handling the events of the outbox, 0 leaves them
+# to flask process-outbox
+OUTBOX_WORKERS = 1
+# events handled with one call to their handler and one commit at most
+OUTBOX_BATCH_SIZE = 500
+# seconds a claimed event is hidden from other workers, after which a failed
+# or abandoned event is tried again
+OUTBOX_LEASE = 30
+# events failing this many times are kept but no longer tried
+OUTBOX_MAX_ATTEMPTS = 10
+# seconds between checks for events added by other processes
+OUTBOX_POLL_INTERVAL = 1
+# reviews of the mean grade every program starts with in the Bayesian
+# average of the top listing, so that a few good reviews do not beat many
+RANKING_PRIOR_REVIEWS = 5
+# seconds after which a review counts half as much in the trending listing
+TRENDING_HALF_LIFE = 3 * 24 * 3600
+# programs whose rankings are refreshed in one transaction
+RANKING_BATCH_SIZE = 1000
+# hashes made with other parameters are replaced when the user logs in
+PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+# processes computing password hashes, 0 computes them in the request thread
+PASSWORD_WORKERS = 2
+# hashes computed or waiting at a time at most, logins and registrations
+# over it are refused until the queue shrinks
+PASSWORD_QUEUE_LIMIT = 16
+# login attempts allowed per IP address and per username, and registrations
+# per IP address, in the period of seconds
+LOGIN_ATTEMPTS_PER_IP = 30
+LOGIN_ATTEMPTS_PER_USERNAME = 10
+REGISTRATIONS_PER_IP = 10
+RATE_LIMIT_PERIOD = 600
+# reverse proxies in front of the application whose X-Forwarded-For header
+# is trusted to tell the address of the client. Behind a proxy the limits
+# above would otherwise count the proxy as a single client for everyone.
+TRUSTED_PROXIES = 0
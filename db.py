@@ -1,12 +1,43 @@
+import hashlib
+import logging
 import os
+import queue
+import random
 import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from urllib.parse import quote
 
 import config
+import migrations
+
+logger = logging.getLogger(__name__)
 
 
 class Database:
-    def __init__(self, filename: str, reset: bool = False):
+    def __init__(self, filename: str, reset: bool = False,
+                 pool_size: int = config.DB_POOL_SIZE, replicas=(),
+                 readonly: bool = False):
         self.filename = filename
+        self.pool_size = pool_size
+        self.readonly = readonly
+
+        # idle connections, the most recently used one is handed out first
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        # the connection checked out by the current thread
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self.slow_queries = deque(maxlen=config.SLOW_QUERY_LOG_SIZE)
+
+        if readonly:
+            self._open_replica()
+            return
 
         if reset:
             try:
@@ -14,57 +45,605 @@ class Database:
             except FileNotFoundError:
                 pass
 
-        conn = self._connection()
+        conn = self._connect()
 
-        with open("schema.sql", "r", encoding="utf-8") as f:
-            schema = f.read()
+        # the journal mode is stored in the database file, so it only has to
+        # be set once
+        conn.execute(f"PRAGMA journal_mode = {config.DB_JOURNAL_MODE}")
 
-        try:
-            conn.executescript(schema)
-        except sqlite3.OperationalError:
-            pass
+        applied = migrations.migrate(conn)
+
+        if applied:
+            logger.info("applied %d migrations, schema version is now %d",
+                        applied, migrations.SCHEMA_VERSION)
+
+        # the query planner needs statistics to choose between the indexes,
+        # and new indexes have none
+        sql = "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        if applied or conn.execute(sql).fetchone() is None:
+            self._analyze(conn)
+
+        if self._run_init_script(conn):
+            # a class catalogue cached before the script ran is out of date
+            import program
+            program.invalidate_classes()
+
+        self.has_fts5 = self._create_search_index(conn)
 
+        conn.close()
+
+        # read-only copies of the database that query() and iterate() use
+        # when use_replica() has chosen one for the thread
+        self.replicas = [Database(replica, pool_size=pool_size, readonly=True)
+                         for replica in replicas]
+
+        for replica in self.replicas:
+            replica.slow_queries = self.slow_queries
+
+    # A replica is replaced as a whole by snapshot_replica(), and the
+    # connections to the old file are closed as they are released. A replica
+    # that does not exist yet is not used until a snapshot has created it.
+    def _open_replica(self):
+        self.replicas = []
+        # inode of the current replica file, None if there is none
+        self._inode = None
+        # connection -> inode of the file it was opened to
+        self._inodes = {}
+        self.refresh()
+
+    # Inserts the class catalogue of init.sql. The hash of the script run
+    # last is kept in the database, so an unchanged script is skipped and a
+    # starting process takes no write lock. Returns whether the script was
+    # run.
+    def _run_init_script(self, conn):
         with open("init.sql", "r", encoding="utf-8") as f:
             initscript = f.read()
 
-        conn.executescript(initscript)
+        digest = hashlib.sha256(initscript.encode("utf-8")).hexdigest()
 
-        conn.close()
+        if conn.execute("SELECT hash FROM init_script").fetchone()[0] == digest:
+            return False
+
+        conn.executescript(f"""BEGIN IMMEDIATE;
+                               {initscript}
+                               UPDATE init_script SET hash = '{digest}';
+                               COMMIT;""")
+        return True
 
     def execute(self, query, params=None):
         # PEP 8 recommended style
         if params is None:
             params = []
 
-        conn = self._connection()
+        self._wrote()
+        conn = self.connection()
+
+        # inside transaction() the statement is committed with the block
+        if self.in_transaction():
+            return self._timed(conn, query, params).lastrowid
+
+        def run():
+            try:
+                result = self._timed(conn, query, params)
+                conn.commit()
+                return result.lastrowid
+            except Exception as e:
+                conn.rollback()
+                raise e
+
+        return self._retry_busy(run)
+
+    # Runs the statement once for every parameter list as one batch
+    def executemany(self, query, params):
+        self._wrote()
+        conn = self.connection()
+
+        if self.in_transaction():
+            self._timed(conn, query, params, many=True)
+            return
+
+        def run():
+            try:
+                self._timed(conn, query, params, many=True)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise e
+
+        self._retry_busy(run)
+
+    # Runs the statements of the with block in a single transaction on the
+    # connection of the current thread, so that they are written with one
+    # commit. The transaction is committed at the end of the block and rolled
+    # back if the block raises. Nested blocks join the outermost transaction.
+    # A read transaction only gives the block a consistent snapshot of the
+    # database and does not block writers.
+    @contextmanager
+    def transaction(self, write=True):
+        if self.in_transaction():
+            yield self
+            return
+
+        reader = self._reader()
+        if reader is not None and not write:
+            with reader.transaction(write=False):
+                yield self
+            return
+
+        if write:
+            self._wrote()
+
+        conn = self.connection()
+
+        if write:
+            # takes the write lock up front so that the transaction can not
+            # fail with SQLITE_BUSY halfway through
+            self._retry_busy(lambda: conn.execute("BEGIN IMMEDIATE"))
+        else:
+            conn.execute("BEGIN")
+
+        self._local.in_transaction = True
+
+        self._local.on_commit = []
 
         try:
-            result = conn.execute(query, params)
-        except Exception as e:
-            conn.close()
+            yield self
+        except BaseException as e:
+            conn.rollback()
             raise e
+        else:
+            conn.commit()
 
-        conn.commit()
-        conn.close()
-        return result.lastrowid
+            for callback in self._local.on_commit:
+                callback()
+        finally:
+            self._local.in_transaction = False
+            self._local.on_commit = []
+
+    def in_transaction(self):
+        return getattr(self._local, "in_transaction", False)
+
+    # Calls the function once the current transaction has been committed, or
+    # right away outside transaction(). Nothing is called if the transaction
+    # is rolled back.
+    def after_commit(self, callback):
+        if self.in_transaction():
+            self._local.on_commit.append(callback)
+        else:
+            callback()
 
-    def query(self, query, params=None):
+    # Sends the reads of the current thread to a random replica until
+    # release(), if there are any. A replica is only chosen if it has at
+    # least the given content version, so that a client sees its own writes
+    # even when the replicas lag behind. Returns whether one was chosen.
+    def use_replica(self, min_version=None):
+        replicas = self.replicas.copy()
+        random.shuffle(replicas)
+
+        for replica in replicas:
+            if not replica.refresh():
+                continue
+
+            if min_version is not None:
+                sql = "SELECT version FROM content_version"
+                version = replica.query(sql)[0][0]
+
+                if version < min_version:
+                    replica.release()
+                    continue
+
+            self._local.reader = replica
+            return True
+
+        return False
+
+    # Tells whether the current thread has written since release()
+    def has_written(self):
+        return getattr(self._local, "wrote", False)
+
+    # Writes go to this database, and so do all reads after them, so that
+    # they see the write
+    def _wrote(self):
+        reader = getattr(self._local, "reader", None)
+        self._local.wrote = True
+        self._local.reader = None
+
+        # the connection of the replica goes back to its pool
+        if reader is not None:
+            reader.release()
+
+    def _reader(self):
+        if self.in_transaction():
+            return None
+
+        return getattr(self._local, "reader", None)
+
+    # Returns all rows of the query. A row factory taking the cursor and the
+    # row tuple can turn the rows into objects as they are read.
+    def query(self, query, params=None, row_factory=None):
         # PEP 8 recommended style
         if params is None:
             params = []
 
-        conn = self._connection()
+        reader = self._reader()
+        if reader is not None:
+            return reader.query(query, params, row_factory)
+
+        return self._timed(self.connection(), query, params, fetch=True,
+                           row_factory=row_factory)
+
+    # Runs a query and yields its rows as they are read from the database
+    # instead of collecting them into a list first
+    def iterate(self, query, params=None, row_factory=None):
+        # PEP 8 recommended style
+        if params is None:
+            params = []
+
+        reader = self._reader()
+        if reader is not None:
+            yield from reader.iterate(query, params, row_factory)
+            return
+
+        conn = self.connection()
+        start = time.perf_counter()
+        cursor = conn.cursor()
+        cursor.row_factory = row_factory
+        cursor.execute(query, params)
+        duration = time.perf_counter() - start
+        rows = 0
 
         try:
-            result = conn.execute(query, params).fetchall()
-        except Exception as e:
-            conn.close()
-            raise e
+            while True:
+                start = time.perf_counter()
+                batch = cursor.fetchmany(config.DB_FETCH_SIZE)
+                duration += time.perf_counter() - start
+
+                if not batch:
+                    break
+
+                for row in batch:
+                    rows += 1
+                    yield row
+        finally:
+            cursor.close()
+            self._record(conn, query, params, duration, rows)
+
+    # Starts recording the statements run by the current thread
+    def start_profile(self):
+        self._local.profile = QueryProfile([])
+
+        for replica in self.replicas:
+            replica._local.profile = self._local.profile
+
+    # Stops recording and returns the statements recorded since
+    # start_profile()
+    def stop_profile(self):
+        profile = getattr(self._local, "profile", None)
+        self._local.profile = None
+
+        for replica in self.replicas:
+            replica._local.profile = None
+
+        return profile
+
+    # Returns the connection of the current thread, checking one out of the
+    # pool if the thread does not have one yet. The connection is kept until
+    # release() is called, so all statements of a request share it.
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            conn = self._acquire()
+            self._local.conn = conn
+
+        return conn
+
+    # Returns the connection of the current thread back to the pool
+    def release(self):
+        reader = getattr(self._local, "reader", None)
+        self._local.reader = None
+        self._local.wrote = False
+
+        if reader is not None:
+            reader.release()
+
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            return
+
+        self._local.conn = None
+        self._local.in_transaction = False
+
+        if conn.in_transaction:
+            conn.rollback()
+
+        if self.readonly and self._inodes.get(conn) != self._inode:
+            # opened to a replaced replica
+            self._close(conn)
+            return
 
+        self._pool.put(conn)
+
+    # Notices if the replica file has been replaced or removed, closing the
+    # idle connections to the old file. Returns whether the replica exists.
+    def refresh(self):
+        try:
+            inode = os.stat(self.filename).st_ino
+        except FileNotFoundError:
+            inode = None
+
+        if inode == self._inode:
+            return inode is not None
+
+        with self._lock:
+            self._inode = inode
+
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+
+            self._close(conn)
+
+        return inode is not None
+
+    def _close(self, conn):
         conn.close()
-        return result
 
-    def _connection(self):
-        return sqlite3.connect(self.filename)
+        with self._lock:
+            self._inodes.pop(conn, None)
+            self._opened -= 1
+
+    # Copies the database into a replica file. The copy is made next to the
+    # file and moved in place of it, so readers of the replica never see a
+    # partial copy.
+    def snapshot_replica(self, filename):
+        temp = f"{filename}.{os.getpid()}.tmp"
+        target = sqlite3.connect(temp)
+
+        try:
+            self.connection().backup(target)
+            # a read-only replica can not create the WAL index
+            target.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            target.close()
+
+        os.replace(temp, filename)
+
+    def stats(self):
+        with self._lock:
+            return PoolStats(self.pool_size, self._opened, self._pool.qsize(),
+                             self._waits, self._wait_time)
+
+    # Recomputes all aggregates from the programs and reviews
+    def rebuild_aggregates(self):
+        with open("aggregates.sql", "r", encoding="utf-8") as f:
+            script = f.read()
+
+        conn = self.connection()
+
+        with self.transaction():
+            for statement in script.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+
+    def rebuild_search_index(self):
+        if self.has_fts5:
+            self.execute("INSERT INTO programs_fts (programs_fts) VALUES ('rebuild')")
+
+    # Updates the statistics of the query planner, which should be done
+    # every now and then as the data grows
+    def optimize(self):
+        conn = self.connection()
+        self._analyze(conn)
+        conn.execute("PRAGMA optimize")
+
+    def _analyze(self, conn):
+        # a sample of every index is enough, so that a large database is
+        # analyzed quickly
+        conn.execute(f"PRAGMA analysis_limit = {int(config.DB_ANALYSIS_LIMIT)}")
+        conn.execute("ANALYZE")
+        conn.commit()
+
+    # Creates the full-text search index if it does not exist yet and SQLite
+    # has been built with FTS5. Returns whether the index can be used.
+    def _create_search_index(self, conn):
+        sql = "SELECT 1 FROM sqlite_master WHERE name = 'programs_fts'"
+
+        if conn.execute(sql).fetchone() is not None:
+            return True
+
+        with open("search.sql", "r", encoding="utf-8") as f:
+            script = f.read()
+
+        try:
+            conn.executescript(script)
+        except sqlite3.OperationalError:
+            # no such module: fts5
+            return False
+
+        # indexes the programs of a database created before the index
+        conn.execute("INSERT INTO programs_fts (programs_fts) VALUES ('rebuild')")
+        conn.commit()
+
+        return True
+
+    # Runs a statement, recording it in the profile of the current thread and
+    # in the slow query log. Returns the rows if fetch is set, otherwise the
+    # cursor.
+    def _timed(self, conn, query, params, many=False, fetch=False,
+               row_factory=None):
+        start = time.perf_counter()
+        cursor = conn.cursor()
+        cursor.row_factory = row_factory
+
+        if many:
+            cursor.executemany(query, params)
+        else:
+            cursor.execute(query, params)
+
+        rows = cursor.fetchall() if fetch else None
+        duration = time.perf_counter() - start
+
+        self._record(conn, query, None if many else params, duration,
+                     len(rows) if fetch else cursor.rowcount)
+
+        return rows if fetch else cursor
+
+    def _record(self, conn, query, params, duration, rows):
+        profile = getattr(self._local, "profile", None)
+        slow = duration * 1000 >= config.SLOW_QUERY_MS
+
+        if profile is None and not slow:
+            return
+
+        plan = None
+
+        if slow and params is not None and config.EXPLAIN_SLOW_QUERIES:
+            plan = [row[3] for row in
+                    conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+
+        stat = QueryStat(" ".join(query.split()), duration, rows, plan)
+
+        if profile is not None:
+            profile.queries.append(stat)
+
+        if slow:
+            self.slow_queries.append(stat)
+            logger.warning("slow query (%.1f ms, %d rows): %s%s",
+                           duration * 1000, rows, stat.sql,
+                           "".join("\n  " + step for step in plan or []))
+
+    def _retry_busy(self, statement):
+        delay = config.DB_WRITE_BACKOFF
+
+        for attempt in range(config.DB_WRITE_RETRIES + 1):
+            try:
+                return statement()
+            except sqlite3.OperationalError as e:
+                if not is_busy(e) or attempt == config.DB_WRITE_RETRIES:
+                    raise e
+
+            time.sleep(delay)
+            delay *= 2
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._opened < self.pool_size
+
+            if can_open:
+                self._opened += 1
+
+        if can_open:
+            try:
+                return self._connect()
+            except Exception as e:
+                with self._lock:
+                    self._opened -= 1
+                raise e
+
+        start = time.perf_counter()
+
+        try:
+            conn = self._pool.get(timeout=config.DB_POOL_TIMEOUT)
+        except queue.Empty:
+            raise PoolExhausted
+
+        with self._lock:
+            self._waits += 1
+            self._wait_time += time.perf_counter() - start
+
+        return conn
+
+    def _connect(self):
+        if self.readonly:
+            # a replica never changes while it is open, so SQLite does not
+            # have to lock it
+            mode = "ro&immutable=1" if config.DB_REPLICA_IMMUTABLE else "ro"
+            inode = self._inode
+            conn = sqlite3.connect(f"file:{quote(self.filename)}?mode={mode}",
+                                   uri=True, check_same_thread=False,
+                                   timeout=config.DB_BUSY_TIMEOUT / 1000)
+
+            with self._lock:
+                self._inodes[conn] = inode
+        else:
+            # connections move between request threads through the pool
+            conn = sqlite3.connect(self.filename, check_same_thread=False,
+                                   timeout=config.DB_BUSY_TIMEOUT / 1000)
+
+        conn.execute(f"PRAGMA busy_timeout = {int(config.DB_BUSY_TIMEOUT)}")
+        conn.execute(f"PRAGMA synchronous = {config.DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA mmap_size = {int(config.DB_MMAP_SIZE)}")
+        conn.execute(f"PRAGMA cache_size = {int(config.DB_CACHE_SIZE)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+# Tells whether the error is SQLITE_BUSY or SQLITE_LOCKED, including their
+# extended result codes
+def is_busy(error):
+    code = getattr(error, "sqlite_errorcode", 0) & 0xff
+    return code in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+@dataclass
+class QueryStat:
+    sql: str
+    # seconds
+    duration: float
+    # rows returned by a query or changed by other statements
+    rows: int
+    # EXPLAIN QUERY PLAN of slow queries if enabled
+    plan: list[str] | None
+
+@dataclass
+class QueryProfile:
+    queries: list[QueryStat]
+
+    @property
+    def duration(self):
+        return sum(query.duration for query in self.queries)
+
+@dataclass
+class PoolStats:
+    size: int
+    opened: int
+    idle: int
+    waits: int
+    wait_time: float
+
+class PoolExhausted(Exception):
+    pass
+
+# The database of the process. It is opened on first use, or by
+# app.create_app(), so that importing the modules does not touch the database
+# file and the file can still be changed in config before that.
+class LazyDatabase:
+    def __init__(self):
+        self._database = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        with self._lock:
+            if self._database is None:
+                self._database = Database(config.DATABASE_FILE,
+                                          reset=config.RESET_DB,
+                                          replicas=config.DB_REPLICAS)
+
+        return self._database
+
+    def __getattr__(self, name):
+        database = self._database
+
+        if database is None:
+            database = self.open()
+
+        return getattr(database, name)
 
-db = Database(config.DATABASE_FILE, reset=config.RESET_DB)
+db = LazyDatabase()
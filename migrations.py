@@ -0,0 +1,184 @@
+import sqlite3
+import time
+
+import config
+
+# The schema version of a database, stored in PRAGMA user_version, is the
+# number of migrations applied to it. schema.sql always creates the schema of
+# the latest version, and every change to it needs a migration appended here
+# that makes the same change to existing databases.
+
+# Adds a column unless the table has it already
+def add_column(conn, table, column, definition):
+    columns = [c[1] for c in conn.execute(f"PRAGMA table_info({table})")]
+
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+# Databases from before the versioned schema have anything between the
+# original schema and all the columns flask rebuild-aggregates used to add
+def add_aggregates(conn):
+    for table, column in [("programs", "review_count"),
+                          ("programs", "grade_sum"),
+                          ("programs", "version"),
+                          ("programs", "modified"),
+                          ("users", "review_count"),
+                          ("users", "grade_sum"),
+                          ("users", "program_count"),
+                          ("users", "received_grade_sum"),
+                          ("users", "received_weight"),
+                          ("users", "version"),
+                          ("users", "modified"),
+                          ("class_value", "program_count")]:
+        add_column(conn, table, column, "INTEGER NOT NULL DEFAULT 0")
+
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_pcv_value
+                    ON program_class_value (value, program)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS content_version
+                    (version INTEGER NOT NULL)""")
+    conn.execute("""INSERT INTO content_version (version) SELECT 0
+                    WHERE NOT EXISTS (SELECT 1 FROM content_version)""")
+
+    # a copy of aggregates.sql at the time, as later versions of the file
+    # may use columns added by later migrations
+    for statement in AGGREGATES_V1.split(";"):
+        if statement.strip():
+            conn.execute(statement)
+
+AGGREGATES_V1 = """
+UPDATE programs SET review_count = 0, grade_sum = 0;
+
+UPDATE programs SET review_count = r.review_count, grade_sum = r.grade_sum
+FROM (SELECT program, COUNT(*) AS review_count, SUM(grade) AS grade_sum
+      FROM reviews GROUP BY program) r
+WHERE programs.id = r.program;
+
+UPDATE users SET review_count = 0, grade_sum = 0;
+
+UPDATE users SET review_count = r.review_count, grade_sum = r.grade_sum
+FROM (SELECT author, COUNT(*) AS review_count, SUM(grade) AS grade_sum
+      FROM reviews GROUP BY author) r
+WHERE users.id = r.author;
+
+UPDATE users SET program_count = 0, received_grade_sum = 0,
+received_weight = 0;
+
+UPDATE users SET program_count = p.program_count,
+received_grade_sum = p.grade_sum, received_weight = p.weight
+FROM (SELECT author, COUNT(*) AS program_count, SUM(grade_sum) AS grade_sum,
+      SUM(MAX(review_count, 1)) AS weight FROM programs GROUP BY author) p
+WHERE users.id = p.author;
+
+UPDATE class_value SET program_count = (SELECT COUNT(*)
+FROM program_class_value pcv WHERE pcv.value = class_value.id);
+"""
+
+# The class values of a program are read with the program, so the index
+# covers them and the rows themselves are never read
+def cover_program_class_values(conn):
+    conn.execute("DROP INDEX IF EXISTS idx_pcv")
+    conn.execute("""CREATE INDEX idx_pcv
+                    ON program_class_value (program, value)""")
+
+# The hash of init.sql when it was run last, so that it is only run again
+# after it has changed
+def track_init_script(conn):
+    conn.execute("CREATE TABLE init_script (hash TEXT NOT NULL)")
+    conn.execute("INSERT INTO init_script (hash) VALUES ('')")
+
+# Events handled in the background by outbox.py
+def add_outbox(conn):
+    conn.execute("""CREATE TABLE outbox (id INTEGER PRIMARY KEY,
+                    topic TEXT NOT NULL, payload TEXT NOT NULL,
+                    created REAL NOT NULL, available REAL NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0)""")
+    conn.execute("CREATE INDEX idx_outbox_available ON outbox (available)")
+
+# Tables for the sorted listings. The existing reviews have no times, so
+# they do not count as trending, and the rankings are what a full refresh
+# would compute.
+def add_rankings(conn):
+    add_column(conn, "reviews", "created", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX idx_pmodified ON programs (modified)")
+    conn.execute("""CREATE TABLE program_ranking (
+                    program INTEGER PRIMARY KEY REFERENCES programs,
+                    top REAL NOT NULL, trending REAL NOT NULL,
+                    reviews INTEGER NOT NULL)""")
+
+    for column in ["top", "trending", "reviews"]:
+        conn.execute(f"""CREATE INDEX idx_ranking_{column}
+                         ON program_ranking ({column}, program)""")
+
+    conn.execute("""CREATE TABLE ranking_state (refreshed INTEGER NOT NULL,
+                    mean REAL NOT NULL)""")
+    conn.execute("""INSERT INTO ranking_state (refreshed, mean)
+                    SELECT ?, IFNULL(SUM(grade_sum) * 1.0 / SUM(review_count),
+                    0) FROM programs""", [int(time.time())])
+    conn.execute("""INSERT INTO program_ranking (program, top, trending,
+                    reviews) SELECT p.id, (? * s.mean + p.grade_sum)
+                    / (? + p.review_count), 0, p.review_count
+                    FROM programs p, ranking_state s""",
+                 [config.RANKING_PRIOR_REVIEWS] * 2)
+
+MIGRATIONS = [
+    add_aggregates,
+    cover_program_class_values,
+    track_init_script,
+    add_outbox,
+    add_rankings,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# Creates the schema in an empty database and brings an existing one up to
+# date one migration at a time. Every migration is committed together with
+# the new version, so a failed migration is simply run again on the next
+# start. Returns the number of migrations applied.
+def migrate(conn):
+    sql = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'"
+
+    if conn.execute(sql).fetchone() is None:
+        with open("schema.sql", "r", encoding="utf-8") as f:
+            schema = f.read()
+
+        try:
+            # executescript() commits before running the script, so the
+            # transaction has to be a part of the script
+            conn.executescript(f"""BEGIN IMMEDIATE;
+                                   {schema}
+                                   PRAGMA user_version = {SCHEMA_VERSION};
+                                   COMMIT;""")
+            return 0
+        except sqlite3.OperationalError:
+            # another process created the schema first
+            conn.rollback()
+
+    # an up to date database is only read, so starting processes do not
+    # wait for each other or for writers
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return 0
+
+    applied = 0
+
+    while True:
+        # the write lock is taken before reading the version, so processes
+        # starting at the same time never run the same migration twice
+        conn.execute("BEGIN IMMEDIATE")
+        version = schema_version(conn)
+
+        if version >= SCHEMA_VERSION:
+            conn.rollback()
+            return applied
+
+        try:
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+
+        applied += 1
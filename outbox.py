@@ -0,0 +1,146 @@
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+import config
+from db import db
+
+logger = logging.getLogger(__name__)
+
+# Work that does not have to be done while the user waits is written into the
+# outbox table in the same transaction as the change causing it, and done
+# later by worker threads. An event is deleted only after its handler has
+# committed, so every event is handled at least once, and a handler may see
+# an event again if the process stops halfway. Handlers therefore have to be
+# idempotent, for example recompute values instead of adding to them.
+
+# topic -> function taking a list of the payloads of a batch of events
+handlers = {}
+
+_workers = []
+_lock = threading.Lock()
+# set when an event is added, so that idle workers start at once
+_wake = threading.Event()
+# totals of this process for queue_stats()
+_handled = 0
+_failed = 0
+
+# Registers the decorated function as the handler of the events of the topic
+def handler(topic):
+    def decorator(f):
+        handlers[topic] = f
+        return f
+    return decorator
+
+# Adds an event to the outbox, within the transaction of the caller if there
+# is one, so the event is only handled if the change causing it is committed
+def enqueue(topic, payload):
+    sql = "INSERT INTO outbox (topic, payload, created) VALUES (?, ?, ?)"
+    db.execute(sql, [topic, json.dumps(payload), time.time()])
+
+    db.after_commit(_wake.set)
+
+# Claims a batch of events and handles the events of each topic with a single
+# call to the handler, committed together with the deletion of the events.
+# A claimed event is hidden from other workers for OUTBOX_LEASE seconds, and
+# a failed batch is tried again after that. At most limit events are
+# claimed, OUTBOX_BATCH_SIZE by default. Returns the number of events handled.
+def process_batch(limit=None):
+    global _handled, _failed
+
+    if limit is None:
+        limit = config.OUTBOX_BATCH_SIZE
+
+    now = time.time()
+    sql = """UPDATE outbox SET available = ?, attempts = attempts + 1
+             WHERE id IN (SELECT id FROM outbox WHERE available <= ?
+             AND attempts < ? ORDER BY available, id LIMIT ?)
+             RETURNING id, topic, payload"""
+
+    try:
+        with db.transaction():
+            events = db.query(sql, [now + config.OUTBOX_LEASE, now,
+                                    config.OUTBOX_MAX_ATTEMPTS, limit])
+
+        topics = {}
+        for event_id, topic, payload in events:
+            topics.setdefault(topic, []).append((event_id, payload))
+
+        handled = 0
+
+        for topic, batch in topics.items():
+            try:
+                with db.transaction():
+                    handlers[topic]([json.loads(payload)
+                                     for _, payload in batch])
+
+                    sql = "DELETE FROM outbox WHERE id = ?"
+                    db.executemany(sql, [[event_id] for event_id, _ in batch])
+            except Exception:
+                logger.exception("handling %d %s events failed", len(batch),
+                                 topic)
+
+                with _lock:
+                    _failed += len(batch)
+            else:
+                handled += len(batch)
+
+                with _lock:
+                    _handled += len(batch)
+
+        return handled
+    finally:
+        db.release()
+
+# Handles events until the outbox is empty, then waits for new ones. An
+# event added by another process is noticed within OUTBOX_POLL_INTERVAL
+# seconds.
+def work():
+    while True:
+        _wake.clear()
+
+        try:
+            if process_batch():
+                continue
+        except Exception:
+            logger.exception("reading the outbox failed")
+
+        _wake.wait(config.OUTBOX_POLL_INTERVAL)
+
+# Starts the OUTBOX_WORKERS worker threads of the process unless they are
+# running already. Called by app.create_app(), other processes handle the
+# events with work() or process_batch().
+def start_workers():
+    with _lock:
+        if _workers:
+            return
+
+        for i in range(config.OUTBOX_WORKERS):
+            worker = threading.Thread(target=work, name=f"outbox-{i}",
+                                      daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+# Returns the number of events waiting and how long the oldest of them has
+# waited, which is how far behind the derived data is
+def queue_stats():
+    sql = """SELECT COUNT(*), MIN(IIF(attempts < ?, created, NULL)),
+             SUM(attempts >= ?) FROM outbox"""
+    pending, oldest, dead = db.query(sql, [config.OUTBOX_MAX_ATTEMPTS] * 2)[0]
+    lag = time.time() - oldest if oldest is not None else 0.0
+
+    with _lock:
+        return QueueStats(pending, dead or 0, lag, _handled, _failed,
+                          len(_workers))
+
+@dataclass
+class QueueStats:
+    pending: int
+    # events that failed OUTBOX_MAX_ATTEMPTS times and are no longer tried
+    dead: int
+    lag_seconds: float
+    handled: int
+    failed: int
+    workers: int
@@ -0,0 +1,71 @@
+from dataclasses import dataclass
+
+import config
+
+
+# Describes how to fetch one page of rows ordered by an id column. A page is
+# either given with a cursor, the id of the last row of the previous page
+# (after) or of the first row of the next page (before), or with a page
+# number. Cursors make every page as cheap as the first one, page numbers are
+# only kept for old ?p= links and use OFFSET. For other orders the column
+# can be a row value ending with the id, and value the SQL looking up the
+# row value of the cursor id.
+@dataclass
+class Keyset:
+    conditions: list[str]
+    params: list[int]
+    order: str
+    offset: int
+    limit: int
+    reverse: bool
+    has_previous: bool
+
+def keyset(column, descending, page=0, after=None, before=None, value="?"):
+    reverse = before is not None and after is None
+    cursor = before if reverse else after
+
+    # the rows are scanned backwards when going to the previous page
+    scan_descending = descending != reverse
+    order = "DESC" if scan_descending else "ASC"
+
+    conditions = []
+    params = []
+    offset = 0
+
+    if cursor is not None:
+        operator = "<" if scan_descending else ">"
+        conditions.append(f"{column} {operator} {value}")
+        params.append(cursor)
+    else:
+        offset = page * config.ITEMS_PER_PAGE
+
+    has_previous = after is not None or (cursor is None and page > 0)
+
+    return Keyset(conditions, params, order, offset, config.ITEMS_PER_PAGE + 1,
+                  reverse, has_previous)
+
+# Takes the rows fetched with the limit of the keyset and returns the rows of
+# the page in display order, whether there is a next page and whether there
+# is a previous page
+def split_page(rows, keys):
+    more = len(rows) == keys.limit
+
+    if more:
+        rows = rows[:-1]
+
+    if keys.reverse:
+        rows.reverse()
+        return rows, True, more
+
+    return rows, more, keys.has_previous
+
+# Returns the cursors for links to the previous and the next page of a
+# listing, None if there is no such page
+def page_cursors(rows, has_previous, has_more):
+    if not rows:
+        return None, None
+
+    prev_cursor = rows[0].id if has_previous else None
+    next_cursor = rows[-1].id if has_more else None
+
+    return prev_cursor, next_cursor
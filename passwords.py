@@ -0,0 +1,83 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import config
+
+# Password hashes are deliberately slow to compute, so they are computed in
+# a few processes of their own instead of the threads serving requests. At
+# most PASSWORD_QUEUE_LIMIT hashes are computed or waiting at a time, more are
+# refused with HashQueueFull instead of letting a burst of logins queue up.
+_pool = None
+_pending = 0
+_lock = threading.Lock()
+
+def _submit(function, *args):
+    global _pending
+
+    if config.PASSWORD_WORKERS == 0:
+        return function(*args)
+
+    with _lock:
+        if _pending >= config.PASSWORD_QUEUE_LIMIT:
+            raise HashQueueFull
+
+        _pending += 1
+
+    try:
+        # a pool one of whose processes has died, for example killed for
+        # running out of memory, refuses all work, so it is replaced with a
+        # new one and the hash is tried once more
+        for _ in range(2):
+            pool = _get_pool()
+
+            try:
+                return pool.submit(function, *args).result()
+            except BrokenProcessPool:
+                _discard_pool(pool)
+
+        raise HashQueueFull
+    finally:
+        with _lock:
+            _pending -= 1
+
+def _get_pool():
+    global _pool
+
+    with _lock:
+        if _pool is None:
+            # fork would copy the locks and connections of the request
+            # threads into the workers
+            _pool = ProcessPoolExecutor(
+                config.PASSWORD_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"))
+
+        return _pool
+
+def _discard_pool(pool):
+    global _pool
+
+    with _lock:
+        # another thread may have replaced it already
+        if _pool is pool:
+            _pool = None
+
+    pool.shutdown(wait=False)
+
+def hash_password(password):
+    return _submit(generate_password_hash, password,
+                   config.PASSWORD_HASH_METHOD)
+
+def check_password(password_hash, password):
+    return _submit(check_password_hash, password_hash, password)
+
+# Tells whether the hash was made with other parameters than the configured
+# ones and should be replaced when the password is next known
+def needs_rehash(password_hash):
+    return password_hash.split("$", 1)[0] != config.PASSWORD_HASH_METHOD
+
+class HashQueueFull(Exception):
+    pass
@@ -1,17 +1,28 @@
+import math
+import re
 import sqlite3
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
 
 import config
+import outbox
 from db import db
+from pagination import keyset, split_page
 
 
+# the average grade of a program from its precomputed review aggregates
+AVERAGE_GRADE = "IFNULL(p.grade_sum * 1.0 / p.review_count, 0)"
+
 def get_program(program_id):
     try:
-        sql = """SELECT p.name, u.username, u.id, p.source_link,
-                 p.download_link, p.description, IFNULL(AVG(r.grade), 0)
-                 FROM programs p, users u
-                 LEFT JOIN reviews r ON r.program = p.id
-                 WHERE p.author = u.id AND p.id = ?"""
+        # the class values are fetched in the same query and named from the
+        # cached class catalogue
+        sql = f"""SELECT p.name, u.username, u.id, p.source_link,
+                  p.download_link, p.description, {AVERAGE_GRADE}, p.version,
+                  (SELECT group_concat(value) FROM program_class_value
+                  WHERE program = p.id)
+                  FROM programs p, users u
+                  WHERE p.author = u.id AND p.id = ?"""
         res = db.query(sql, [program_id])[0]
 
         name = res[0]
@@ -21,113 +32,534 @@ def get_program(program_id):
         download_link = res[4]
         description = res[5]
         grade = res[6]
+        version = res[7]
+        class_values = res[8].split(",") if res[8] else []
     except IndexError:
         raise ProgramNotFound
 
-    sql = """SELECT c.name, cv.value
-             FROM program_class_value pcv, class_value cv, classes c
-             WHERE pcv.program = ? AND pcv.value = cv.id AND c.id = cv.class
-             ORDER BY c.name, cv.value"""
-    classes = db.query(sql, [program_id])
+    values = get_class_catalogue().values
+    classes = sorted(values[int(value)] for value in class_values
+                     if int(value) in values)
 
     return Program(name, program_id, author_name, author_id, description,
-                   source_link, download_link, grade, classes)
-
-def get_programs(page=0):
-    # a subquery is used because it is much faster
-    sql = """SELECT p.id, p.name, p.description, u.username, u.id,
-             IFNULL(AVG(r.grade), 0) FROM
-             (SELECT id, name, description, author
-             FROM programs ORDER BY id DESC LIMIT ? OFFSET ?) p, users u
-             LEFT JOIN reviews r ON r.program = p.id
-             WHERE u.id = p.author GROUP BY p.id ORDER BY p.id DESC"""
-    programs = db.query(sql, [config.ITEMS_PER_PAGE + 1,
-                              page * config.ITEMS_PER_PAGE])
-    programs = [Program(p[1], p[0], p[3], p[4], p[2], None, None, p[5], None)
-                for p in programs]
-
-    has_more = False
-
-    if len(programs) == config.ITEMS_PER_PAGE + 1:
-        programs = programs[:-1]
-        has_more = True
-
-    return ProgramListing(programs, has_more)
-
-def search_programs(searchtext, page=0):
-    # a subquery is used because it is much faster
-    sql = """SELECT p.id, p.name, p.description, u.username, u.id,
-             IFNULL(AVG(r.grade), 0) FROM
-             (SELECT id, name, description, author FROM programs
-             WHERE name LIKE ? OR description LIKE ? ORDER BY id DESC LIMIT ?
-             OFFSET ?) p, users u LEFT JOIN reviews r ON r.program = p.id
-             WHERE u.id = p.author GROUP BY p.id ORDER BY p.id DESC"""
-    programs = db.query(sql, ["%" + searchtext + "%", "%" + searchtext + "%",
-                              config.ITEMS_PER_PAGE + 1,
-                              page * config.ITEMS_PER_PAGE])
-    programs = [Program(p[1], p[0], p[3], p[4], p[2], None, None, p[5], None)
-                for p in programs]
-
-    has_more = False
-
-    if len(programs) == config.ITEMS_PER_PAGE + 1:
-        programs = programs[:-1]
-        has_more = True
-
-    return ProgramListing(programs, has_more)
+                   source_link, download_link, grade, classes, version)
+
+# Yields every program oldest first, reading them from the database while
+# they are iterated instead of loading them all into memory
+def iterate_programs():
+    sql = f"""SELECT p.id, p.name, p.description, u.username, u.id,
+              {AVERAGE_GRADE}, p.version FROM programs p, users u
+              WHERE u.id = p.author ORDER BY p.id"""
+    return db.iterate(sql, row_factory=ProgramCard.from_row)
+
+# sort parameter -> column of program_ranking the listing is sorted by
+RANKINGS = {"top": "top", "trending": "trending", "most_reviewed": "reviews"}
+
+# Returns a page of programs, newest first or by one of the RANKINGS. Only
+# programs having all of the class value IDs in values are included.
+def get_programs(page=0, after=None, before=None, values=(), sort=None):
+    if sort in RANKINGS:
+        return get_ranked_programs(RANKINGS[sort], page, after, before,
+                                   values)
+
+    keys = keyset("p.id", True, page, after, before)
+    conditions, params = class_filter(values, "p.id")
+    conditions += keys.conditions
+    where = " ".join("AND " + condition for condition in conditions)
+
+    sql = f"""SELECT p.id, p.name, p.description, u.username, u.id,
+              {AVERAGE_GRADE}, p.version FROM programs p, users u
+              WHERE u.id = p.author {where}
+              ORDER BY p.id {keys.order} LIMIT ? OFFSET ?"""
+    programs = db.query(sql, params + keys.params + [keys.limit, keys.offset],
+                        row_factory=ProgramCard.from_row)
+    programs, has_more, has_previous = split_page(programs, keys)
+
+    return ProgramListing(programs, has_more, has_previous)
+
+# The listing is read in the order of the index of the ranking column, and the
+# cursor is a program ID like in the other listings. The ranking of a deleted
+# program is kept until the next full refresh, so that a cursor pointing to
+# it keeps its place.
+def get_ranked_programs(column, page, after, before, values):
+    cursor_id = after if after is not None else before
+    sql = "SELECT 1 FROM program_ranking WHERE program = ?"
+
+    # a cursor without a ranking starts the listing from the beginning
+    # instead of finding nothing
+    if cursor_id is not None and not db.query(sql, [cursor_id]):
+        after = before = None
+
+    cursor = f"""(SELECT {column}, program FROM program_ranking
+                 WHERE program = ?)"""
+    keys = keyset(f"(r.{column}, r.program)", True, page, after, before,
+                  cursor)
+    conditions, params = class_filter(values, "r.program")
+    conditions += keys.conditions
+    where = " ".join("AND " + condition for condition in conditions)
+
+    sql = f"""SELECT p.id, p.name, p.description, u.username, u.id,
+              {AVERAGE_GRADE}, p.version FROM program_ranking r, programs p,
+              users u WHERE p.id = r.program AND u.id = p.author {where}
+              ORDER BY r.{column} {keys.order}, r.program {keys.order}
+              LIMIT ? OFFSET ?"""
+    programs = db.query(sql, params + keys.params + [keys.limit, keys.offset],
+                        row_factory=ProgramCard.from_row)
+    programs, has_more, has_previous = split_page(programs, keys)
+
+    return ProgramListing(programs, has_more, has_previous)
+
+# Updates the rankings of the programs changed since the last refresh, or of
+# all programs with full, a batch at a time so that writers are not blocked
+# for long. The mean grade the averages are pulled towards changes slowly
+# and changing it changes every score, so it is only recomputed by a full
+# refresh. Returns the number of programs updated.
+def refresh_rankings(full=False):
+    started = int(time.time())
+    refreshed, mean = db.query("SELECT refreshed, mean FROM ranking_state")[0]
+    full = full or refreshed == 0
+
+    if full:
+        sql = "SELECT SUM(grade_sum) * 1.0 / SUM(review_count) FROM programs"
+        mean = db.query(sql)[0][0] or 0.0
+        index, condition, params = "", "", []
+    else:
+        # the statistics of the index describe all programs, most of which
+        # have not changed in a long time, so the planner would scan the
+        # whole table instead
+        index = "INDEXED BY idx_pmodified"
+        # a program changed during the last refresh may have been missed,
+        # so the second it started is refreshed again
+        condition, params = "AND modified >= ?", [refreshed]
+
+    updated = 0
+    last = 0
+
+    while True:
+        with db.transaction():
+            sql = f"""SELECT id, grade_sum, review_count FROM programs
+                      {index} WHERE id > ? {condition} ORDER BY id LIMIT ?"""
+            programs = db.query(sql, [last] + params
+                                + [config.RANKING_BATCH_SIZE])
+
+            if not programs:
+                break
+
+            ids = [program[0] for program in programs]
+            review_times = {}
+
+            # reviews from before their times were recorded do not count
+            sql = f"""SELECT program, created FROM reviews
+                      WHERE program IN ({", ".join("?" * len(ids))})
+                      AND created > 0"""
+            for program_id, created in db.query(sql, ids):
+                review_times.setdefault(program_id, []).append(created)
+
+            sql = """INSERT OR REPLACE INTO program_ranking (program, top,
+                     trending, reviews) VALUES (?, ?, ?, ?)"""
+            db.executemany(sql, [
+                [program_id, bayesian_average(grade_sum, review_count, mean),
+                 trending_score(review_times.get(program_id, [])),
+                 review_count]
+                for program_id, grade_sum, review_count in programs])
+
+        last = ids[-1]
+        updated += len(programs)
+
+    with db.transaction():
+        # the rankings of deleted programs are only kept for the cursors of
+        # listings being paged
+        if full:
+            db.execute("""DELETE FROM program_ranking WHERE program NOT IN
+                          (SELECT id FROM programs)""")
+
+        db.execute("UPDATE ranking_state SET refreshed = ?, mean = ?",
+                   [started, mean])
+
+        # cached listings are keyed by the content version
+        if updated:
+            bump_content_version()
+
+    return updated
+
+# The average grade of a program as if it also had RANKING_PRIOR_REVIEWS
+# reviews of the mean grade
+def bayesian_average(grade_sum, review_count, mean):
+    prior = config.RANKING_PRIOR_REVIEWS
+    return (prior * mean + grade_sum) / (prior + review_count)
+
+# Returns log2 of the sum of 2 ** (t / TRENDING_HALF_LIFE) over the review
+# times t. Every review loses half of its weight in a half-life, but as the
+# weights of all reviews shrink at the same rate, weighing them from a fixed
+# point in time keeps the order of the programs right. A score therefore only
+# has to be computed again when the program gets new reviews.
+def trending_score(review_times):
+    if not review_times:
+        return 0.0
+
+    exponents = [created / config.TRENDING_HALF_LIFE
+                 for created in review_times]
+    highest = max(exponents)
+
+    # the largest term is taken out of the sum, so that it never overflows
+    return highest + math.log2(sum(2 ** (exponent - highest)
+                                   for exponent in exponents))
+
+# Returns programs whose name or description contains the words of the search
+# text, newest first. With ranked the programs are ordered by relevance
+# instead and paged only with page numbers. Only programs having all of the
+# class value IDs in values are included.
+def search_programs(searchtext, page=0, after=None, before=None,
+                    ranked=False, values=()):
+    match = fts_query(searchtext)
+
+    if not db.has_fts5 or match is None:
+        return like_search_programs(searchtext, page, after, before, values)
+
+    if ranked:
+        keys = keyset("programs_fts.rowid", True, page)
+        order = "programs_fts.rank"
+    else:
+        keys = keyset("programs_fts.rowid", True, page, after, before)
+        order = f"programs_fts.rowid {keys.order}"
+
+    conditions, params = class_filter(values, "p.id")
+    conditions += keys.conditions
+    where = " ".join("AND " + condition for condition in conditions)
+
+    sql = f"""SELECT p.id, p.name, p.description, u.username, u.id,
+              {AVERAGE_GRADE}, p.version
+              FROM programs_fts, programs p, users u
+              WHERE programs_fts MATCH ? AND p.id = programs_fts.rowid
+              AND u.id = p.author {where}
+              ORDER BY {order} LIMIT ? OFFSET ?"""
+    programs = db.query(sql, [match] + params + keys.params
+                        + [keys.limit, keys.offset],
+                        row_factory=ProgramCard.from_row)
+    programs, has_more, has_previous = split_page(programs, keys)
+
+    return ProgramListing(programs, has_more, has_previous)
+
+# Turns the search text into an FTS5 query matching programs that have all of
+# the words as prefixes of words in the name or the description. Returns None
+# if the text contains no words.
+def fts_query(searchtext):
+    words = re.findall(r"\w+", searchtext)
+
+    if not words:
+        return None
+
+    return " ".join(f'"{word}"*' for word in words)
+
+# Search for SQLite builds without FTS5, scans the whole programs table
+def like_search_programs(searchtext, page=0, after=None, before=None,
+                         values=()):
+    keys = keyset("p.id", True, page, after, before)
+    conditions, params = class_filter(values, "p.id")
+    conditions += keys.conditions
+    where = " ".join("AND " + condition for condition in conditions)
+
+    sql = f"""SELECT p.id, p.name, p.description, u.username, u.id,
+              {AVERAGE_GRADE}, p.version FROM programs p, users u
+              WHERE u.id = p.author
+              AND (p.name LIKE ? OR p.description LIKE ?) {where}
+              ORDER BY p.id {keys.order} LIMIT ? OFFSET ?"""
+    programs = db.query(sql, ["%" + searchtext + "%", "%" + searchtext + "%"]
+                        + params + keys.params + [keys.limit, keys.offset],
+                        row_factory=ProgramCard.from_row)
+    programs, has_more, has_previous = split_page(programs, keys)
+
+    return ProgramListing(programs, has_more, has_previous)
+
+# Returns SQL conditions and their parameters limiting the program IDs in the
+# given column to programs having all of the class value IDs in values. Each
+# condition is a lookup in the (value, program) index.
+def class_filter(values, column):
+    condition = f"""EXISTS (SELECT 1 FROM program_class_value
+                    WHERE value = ? AND program = {column})"""
+    return [condition] * len(values), list(values)
+
+# Returns the classes with the number of programs having each value among the
+# programs matching the search text (if any) and the selected class values.
+# The programs are counted only up to FACET_COUNT_LIMIT, over it the counts
+# are marked as lower bounds. The later pages of a listing leave the counts
+# out, as counting is as slow as reading all of the matching programs.
+def get_facets(values=(), searchtext=None, counts=True):
+    match = fts_query(searchtext) if searchtext is not None else None
+    more = False
+
+    if not counts:
+        counts = None
+    elif searchtext is None and not values:
+        # the whole catalogue, counted in advance
+        counts = dict(db.query("SELECT id, program_count FROM class_value"))
+    else:
+        if searchtext is None:
+            # the first value drives the (value, program) index and the
+            # rest are checked for each of its programs
+            conditions, params = class_filter(values[1:], "f.program")
+            sql = """SELECT f.program FROM program_class_value f
+                     WHERE f.value = ?"""
+            params = [values[0]] + params
+        elif db.has_fts5 and match is not None:
+            conditions, params = class_filter(values, "programs_fts.rowid")
+            sql = """SELECT programs_fts.rowid FROM programs_fts
+                     WHERE programs_fts MATCH ?"""
+            params = [match] + params
+        else:
+            conditions, params = class_filter(values, "p.id")
+            sql = """SELECT p.id FROM programs p
+                     WHERE (p.name LIKE ? OR p.description LIKE ?)"""
+            params = ["%" + searchtext + "%", "%" + searchtext + "%"] + params
+
+        sql += " ".join(" AND " + condition for condition in conditions)
+        # the matches are read once, and the row with a NULL value tells how
+        # many there were
+        sql = f"""WITH matches AS MATERIALIZED ({sql} LIMIT ?)
+                  SELECT value, COUNT(*) FROM program_class_value
+                  WHERE program IN matches GROUP BY value
+                  UNION ALL SELECT NULL, COUNT(*) FROM matches"""
+        counts = dict(db.query(sql, params + [config.FACET_COUNT_LIMIT + 1]))
+        more = counts.pop(None) > config.FACET_COUNT_LIMIT
+
+    facets = []
+    for clas in get_classes():
+        options = []
+
+        # a program has one value per class, so choosing a value replaces
+        # the value chosen earlier in the same class
+        others = [value for value in values if value not in clas.option_ids]
+
+        for opt in clas.options:
+            selected = opt.id in values
+            filters = others if selected else others + [opt.id]
+            count = counts.get(opt.id, 0) if counts is not None else None
+            options.append(FacetOption(opt.name, opt.id, count, more,
+                                       selected, filters))
+
+        facets.append(Facet(clas.name, clas.id, options))
+
+    return facets
 
 def create_program(author_id, name, source_link, download_link, description,
                    class_values):
-    sql = """INSERT INTO programs (author, name, source_link, download_link,
-             description) VALUES (?, ?, ?, ?, ?)"""
-    try:
-        program_id = db.execute(sql, [author_id, name, source_link,
-                                download_link, description])
-    except sqlite3.IntegrityError:
-        raise ProgramExists
+    with db.transaction():
+        bump_content_version()
+
+        # program IDs of deleted programs can be reused, so a new program
+        # starts from the content version, which is higher than the version
+        # of any program before it
+        sql = """INSERT INTO programs (author, name, source_link, download_link,
+                 description, version, modified) VALUES (?, ?, ?, ?, ?,
+                 (SELECT version FROM content_version), ?)"""
+        try:
+            program_id = db.execute(sql, [author_id, name, source_link,
+                                    download_link, description,
+                                    int(time.time())])
+        except sqlite3.IntegrityError:
+            raise ProgramExists
+
+        # the page of the author lists the program at once, the statistics
+        # of the author are updated in the background
+        bump_user_versions("id = ?", [author_id])
+        outbox.enqueue("user_stats", [author_id])
+
+        if db.has_fts5:
+            sql = """INSERT INTO programs_fts (rowid, name, description)
+                     VALUES (?, ?, ?)"""
+            db.execute(sql, [program_id, name, description])
 
-    for value in class_values:
         sql = "INSERT INTO program_class_value (program, value) VALUES (?, ?)"
-        db.execute(sql, [program_id, value])
+        db.executemany(sql, [[program_id, value] for value in class_values])
+
+        # a program without reviews has the mean grade as its average, so
+        # the sorted listings have it before the next refresh
+        # the ID may be that of a deleted program whose ranking is still kept
+        sql = """INSERT OR REPLACE INTO program_ranking (program, top,
+                 trending, reviews) SELECT ?, mean, 0, 0 FROM ranking_state"""
+        db.execute(sql, [program_id])
+
+        sql = """UPDATE class_value SET program_count = program_count + 1
+                 WHERE id = ?"""
+        db.executemany(sql, [[value] for value in class_values])
 
     return program_id
 
+# The index has no copy of the text, so the old values have to be removed
+# from it before the program changes
+def unindex_program(program_id):
+    if db.has_fts5:
+        sql = """INSERT INTO programs_fts (programs_fts, rowid, name,
+                 description) SELECT 'delete', id, name, description
+                 FROM programs WHERE id = ?"""
+        db.execute(sql, [program_id])
+
 def update_program(program_id, author_id, name, source_link, download_link,
                    description):
-    sql = """UPDATE programs SET name = ?, source_link = ?, download_link = ?,
-             description = ? WHERE id = ? AND author = ?"""
-    db.execute(sql, [name, source_link, download_link, description, program_id,
-                     author_id])
+    with db.transaction():
+        exists = db.query("SELECT 1 FROM programs WHERE id = ? AND author = ?",
+                          [program_id, author_id])
+
+        if not exists:
+            return
+
+        unindex_program(program_id)
+
+        sql = """UPDATE programs SET name = ?, source_link = ?,
+                 download_link = ?, description = ?, version = version + 1,
+                 modified = ? WHERE id = ?"""
+        db.execute(sql, [name, source_link, download_link, description,
+                         int(time.time()), program_id])
+        bump_user_versions("id = ?", [author_id])
+
+        if db.has_fts5:
+            sql = """INSERT INTO programs_fts (rowid, name, description)
+                     VALUES (?, ?, ?)"""
+            db.execute(sql, [program_id, name, description])
+
+        bump_content_version()
 
 def delete_program(program_id):
-    db.execute("DELETE FROM programs WHERE id = ?", [program_id])
-    db.execute("DELETE FROM program_class_value WHERE program = ?",
-               [program_id])
-    db.execute("DELETE FROM reviews WHERE program = ?", [program_id])
+    with db.transaction():
+        # the program and its reviews no longer count in the statistics of
+        # its author and reviewers
+        sql = """SELECT author FROM programs WHERE id = ?
+                 UNION SELECT author FROM reviews WHERE program = ?"""
+        users = [row[0] for row in db.query(sql, [program_id, program_id])]
+
+        bump_user_versions("id IN (SELECT author FROM programs WHERE id = ?)",
+                           [program_id])
+
+        if users:
+            outbox.enqueue("user_stats", users)
+
+        unindex_program(program_id)
+
+        sql = """UPDATE class_value SET program_count = program_count - 1
+                 WHERE id IN (SELECT value FROM program_class_value
+                 WHERE program = ?)"""
+        db.execute(sql, [program_id])
+
+        db.execute("DELETE FROM programs WHERE id = ?", [program_id])
+        db.execute("DELETE FROM program_class_value WHERE program = ?",
+                   [program_id])
+        db.execute("DELETE FROM reviews WHERE program = ?", [program_id])
+
+        bump_content_version()
 
 def review_program(program_id, author_id, grade, comment):
-    try:
-        sql = """INSERT INTO reviews (author, program, grade, comment)
-                 VALUES (?, ?, ?, ?)"""
-        db.execute(sql, [author_id, program_id, grade, comment])
-    except sqlite3.IntegrityError:
-        raise ReviewedAlready
+    with db.transaction():
+        res = db.query("SELECT author FROM programs WHERE id = ?", [program_id])
 
-def get_reviews(program_id):
-    sql = """SELECT r.grade, r.comment, u.username, u.id
-             FROM users u, programs p LEFT JOIN reviews r ON r.program = p.id
-             WHERE u.id = r.author AND p.id = ?"""
-    reviews = db.query(sql, [program_id])
-    reviews = [Review(r[0], r[1], r[3], r[2]) for r in reviews]
+        if not res:
+            raise ProgramNotFound
 
-    return reviews
+        program_author = res[0][0]
+
+        now = int(time.time())
+
+        try:
+            sql = """INSERT INTO reviews (author, program, grade, comment,
+                     created) VALUES (?, ?, ?, ?, ?)"""
+            db.execute(sql, [author_id, program_id, grade, comment, now])
+        except sqlite3.IntegrityError:
+            raise ReviewedAlready
+
+        sql = """UPDATE programs SET review_count = review_count + 1,
+                 grade_sum = grade_sum + ?, version = version + 1,
+                 modified = ? WHERE id = ?"""
+        db.execute(sql, [grade, now, program_id])
+
+        # the statistics of the reviewer and of the author of the program
+        # are updated in the background
+        outbox.enqueue("user_stats", [author_id, program_author])
+
+        bump_content_version()
+
+# The content version is incremented by every change to programs or reviews,
+# so anything rendered from listings can be cached by it. The version of a
+# program is never higher than the content version.
+def get_content_version():
+    return db.query("SELECT version FROM content_version")[0][0]
+
+def bump_content_version():
+    db.execute("UPDATE content_version SET version = version + 1")
+
+# Returns the version of a program and the Unix time it was last modified,
+# 0 if unknown
+def get_program_version(program_id):
+    res = db.query("SELECT version, modified FROM programs WHERE id = ?",
+                   [program_id])
+
+    if not res:
+        raise ProgramNotFound
+
+    return res[0]
+
+# Marks the pages of the users matching the SQL condition changed
+def bump_user_versions(condition, params):
+    sql = f"""UPDATE users SET version = version + 1, modified = ?
+              WHERE {condition}"""
+    db.execute(sql, [int(time.time())] + params)
+
+# Returns the reviews of a program newest first, starting after the review
+# ID before if given. The reviews are read from the database while they are
+# iterated.
+def get_reviews(program_id, before=None):
+    condition = "AND r.id < ?" if before is not None else ""
+    params = [before] if before is not None else []
+
+    sql = f"""SELECT r.grade, r.comment, u.id, u.username, r.id
+              FROM reviews r, users u
+              WHERE r.program = ? AND u.id = r.author {condition}
+              ORDER BY r.id DESC LIMIT ?"""
+    rows = db.iterate(sql, [program_id] + params
+                      + [config.REVIEWS_PER_PAGE + 1],
+                      row_factory=Review.from_row)
+
+    return ReviewPage(rows)
+
+# One page of reviews that can be iterated once. After the iteration
+# next_before is the cursor of the next page, None if there is none.
+class ReviewPage:
+    def __init__(self, rows):
+        self._rows = rows
+        self.next_before = None
+
+    def __iter__(self):
+        last_id = None
+
+        for i, review in enumerate(self._rows):
+            if i == config.REVIEWS_PER_PAGE:
+                # the extra row only tells that there is a next page
+                self.next_before = last_id
+                self._rows.close()
+                break
+
+            last_id = review.id
+            yield review
+
+# The class catalogue only changes when init.sql is run, so it is loaded once
+# and shared by all requests of the process until invalidate_classes() is
+# called or, if CLASS_CACHE_TTL is set, it expires. Opening the database calls
+# invalidate_classes() when it runs a changed init.sql.
+_catalogue = None
+
+def get_class_catalogue():
+    global _catalogue
+
+    catalogue = _catalogue
+
+    if catalogue is not None and (config.CLASS_CACHE_TTL is None
+        or time.monotonic() - catalogue.loaded < config.CLASS_CACHE_TTL):
+        return catalogue
 
-def get_classes():
     sql = """SELECT c.name, v.value, v.id, c.id FROM classes c, class_value v
              WHERE v.class = c.id ORDER BY c.name, v.value"""
     res = db.query(sql)
 
     classes = {}
+    values = {}
     for class_value in res:
         # (class_name, class_id)
         key = (class_value[0], class_value[3])
@@ -136,15 +568,25 @@ def get_classes():
             classes[key] = []
 
         classes[key].append(ClassOption(class_value[1], class_value[2]))
+        values[class_value[2]] = (class_value[0], class_value[1])
 
     classes = [ProgramClass(clas[0][0], clas[0][1], clas[1])
                for clas in classes.items()]
 
-    return classes
+    catalogue = ClassCatalogue(classes, values, time.monotonic())
+    _catalogue = catalogue
+
+    return catalogue
+
+def invalidate_classes():
+    global _catalogue
+    _catalogue = None
+
+def get_classes():
+    return get_class_catalogue().classes
 
 def class_ids():
-    classes = db.query("SELECT c.id FROM classes c")
-    return [x[0] for x in classes]
+    return [clas.id for clas in get_classes()]
 
 @dataclass
 class ClassOption:
@@ -156,6 +598,36 @@ class ProgramClass:
     name: str
     id: int
     options: list[ClassOption]
+    option_ids: set[int] = field(init=False)
+
+    def __post_init__(self):
+        self.option_ids = {opt.id for opt in self.options}
+
+@dataclass
+class ClassCatalogue:
+    classes: list[ProgramClass]
+    # class value ID -> (class name, value)
+    values: dict[int, tuple[str, str]]
+    loaded: float
+
+@dataclass
+class FacetOption:
+    name: str
+    id: int
+    # None when the programs were not counted
+    count: int | None
+    # the count is a lower bound, as only FACET_COUNT_LIMIT programs were
+    # counted
+    more: bool
+    selected: bool
+    # the class value IDs to filter with when the option is clicked
+    filters: list[int]
+
+@dataclass
+class Facet:
+    name: str
+    id: int
+    options: list[FacetOption]
 
 @dataclass
 class Program:
@@ -168,18 +640,42 @@ class Program:
     download_link: str
     grade: float
     classes: list[tuple[str, str]]
+    # incremented whenever anything shown about the program changes
+    version: int
+
+# A program in listings, only what its card shows. Listing rows are created
+# directly by the SQLite row factory, so they are slotted to keep them small.
+@dataclass(slots=True)
+class ProgramCard:
+    id: int
+    name: str
+    description: str
+    author_name: str
+    author_id: int
+    grade: float
+    version: int
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        return cls(*row)
 
 @dataclass
 class ProgramListing:
-    programs: list[Program]
+    programs: list[ProgramCard]
     has_more: bool
+    has_previous: bool
 
-@dataclass
+@dataclass(slots=True)
 class Review:
     grade: int
     comment: str
     author_id: int
     author_name: int
+    id: int
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        return cls(*row)
 
 class ProgramExists(Exception):
     pass
@@ -0,0 +1,43 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Allows at most limit hits per key in any period seconds. The hits are
+# counted in the memory of the process, and only the max_keys most recently
+# hit keys are remembered.
+class RateLimiter:
+    def __init__(self, limit, period, max_keys=100000):
+        self.limit = limit
+        self.period = period
+        self.max_keys = max_keys
+        # key -> times of the hits within the period, oldest first
+        self._hits = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Records a hit and tells whether it is within the limit. Hits over the
+    # limit are not recorded, so a client is let in again once its earlier
+    # hits are older than the period.
+    def hit(self, key):
+        now = time.monotonic()
+
+        with self._lock:
+            hits = self._hits.get(key)
+
+            if hits is None:
+                hits = self._hits[key] = []
+
+            self._hits.move_to_end(key)
+
+            while hits and hits[0] <= now - self.period:
+                hits.pop(0)
+
+            if len(hits) >= self.limit:
+                return False
+
+            hits.append(now)
+
+            while len(self._hits) > self.max_keys:
+                self._hits.popitem(last=False)
+
+            return True
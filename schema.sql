@@ -1,7 +1,19 @@
 CREATE TABLE users (
     id INTEGER PRIMARY KEY,
     username TEXT UNIQUE,
-    password TEXT
+    password TEXT,
+    -- number and sum of grades of the reviews given by the user
+    review_count INTEGER NOT NULL DEFAULT 0,
+    grade_sum INTEGER NOT NULL DEFAULT 0,
+    -- number of programs of the user, sum of the grades they have received
+    -- and number of those grades, a program without reviews counting as one
+    program_count INTEGER NOT NULL DEFAULT 0,
+    received_grade_sum INTEGER NOT NULL DEFAULT 0,
+    received_weight INTEGER NOT NULL DEFAULT 0,
+    -- incremented and modified (Unix time) set whenever anything shown on
+    -- the page of the user changes
+    version INTEGER NOT NULL DEFAULT 0,
+    modified INTEGER NOT NULL DEFAULT 0
 );
 
 CREATE TABLE programs (
@@ -10,10 +22,18 @@ CREATE TABLE programs (
     name TEXT UNIQUE,
     source_link TEXT,
     download_link TEXT,
-    description TEXT
+    description TEXT,
+    -- number and sum of grades of the reviews of the program
+    review_count INTEGER NOT NULL DEFAULT 0,
+    grade_sum INTEGER NOT NULL DEFAULT 0,
+    -- incremented and modified (Unix time) set whenever anything shown
+    -- about the program changes
+    version INTEGER NOT NULL DEFAULT 0,
+    modified INTEGER NOT NULL DEFAULT 0
 );
 
 CREATE INDEX idx_pauthor ON programs (author);
+CREATE INDEX idx_pmodified ON programs (modified);
 
 CREATE TABLE reviews (
     id INTEGER PRIMARY KEY,
@@ -21,6 +41,8 @@ CREATE TABLE reviews (
     program INTEGER REFERENCES programs,
     grade INTEGER,
     comment TEXT,
+    -- Unix time, 0 for reviews from before it was recorded
+    created INTEGER NOT NULL DEFAULT 0,
     UNIQUE(author, program) ON CONFLICT ABORT
 );
 
@@ -35,6 +57,8 @@ CREATE TABLE class_value (
     id INTEGER PRIMARY KEY,
     class INTEGER REFERENCES classes,
     value TEXT,
+    -- number of programs having the value
+    program_count INTEGER NOT NULL DEFAULT 0,
     UNIQUE(class, value) ON CONFLICT ABORT
 );
 
@@ -43,4 +67,55 @@ CREATE TABLE program_class_value (
     value INTEGER REFERENCES class_value
 );
 
-CREATE INDEX idx_pcv on program_class_value (program);
+CREATE INDEX idx_pcv on program_class_value (program, value);
+CREATE INDEX idx_pcv_value on program_class_value (value, program);
+
+-- single row incremented by every change to programs or reviews
+CREATE TABLE content_version (
+    version INTEGER NOT NULL
+);
+
+INSERT INTO content_version (version) VALUES (0);
+
+-- hash of init.sql when it was last run
+CREATE TABLE init_script (
+    hash TEXT NOT NULL
+);
+
+INSERT INTO init_script (hash) VALUES ('');
+
+-- events waiting for outbox.py, an event is hidden from the workers until
+-- available (Unix time) while it is being handled
+CREATE TABLE outbox (
+    id INTEGER PRIMARY KEY,
+    topic TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL,
+    available REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX idx_outbox_available ON outbox (available);
+
+-- scores of the programs in the sorted listings, refreshed by
+-- program.refresh_rankings(): the Bayesian average of the grades, the time
+-- decayed number of reviews and the number of reviews
+CREATE TABLE program_ranking (
+    program INTEGER PRIMARY KEY REFERENCES programs,
+    top REAL NOT NULL,
+    trending REAL NOT NULL,
+    reviews INTEGER NOT NULL
+);
+
+CREATE INDEX idx_ranking_top ON program_ranking (top, program);
+CREATE INDEX idx_ranking_trending ON program_ranking (trending, program);
+CREATE INDEX idx_ranking_reviews ON program_ranking (reviews, program);
+
+-- when the rankings were last refreshed (Unix time, 0 for never) and the
+-- mean grade used in the averages
+CREATE TABLE ranking_state (
+    refreshed INTEGER NOT NULL,
+    mean REAL NOT NULL
+);
+
+INSERT INTO ranking_state (refreshed, mean) VALUES (0, 0);
@@ -0,0 +1,17 @@
+-- full-text index of program names and descriptions, kept in sync with the
+-- programs table by program.py
+--
+-- diacritics are kept as ä, ö and å are separate letters in Finnish, and
+-- prefixes of two and three characters are indexed so that searching for
+-- the beginning of a word or a compound word is fast
+CREATE VIRTUAL TABLE programs_fts USING fts5(
+    name,
+    description,
+    content = 'programs',
+    content_rowid = 'id',
+    tokenize = 'unicode61 remove_diacritics 0',
+    prefix = '2 3'
+);
+
+-- matches in the name weigh more than in the description
+INSERT INTO programs_fts (programs_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)');
@@ -1,21 +1,13 @@
+import argparse
+import multiprocessing
+import os
 import random
 import sqlite3
 import sys
+import time
 
-conn = sqlite3.connect("database.db")
-
-with open("schema.sql", "r", encoding="utf-8") as f:
-    schema = f.read()
-
-try:
-    conn.executescript(schema)
-except sqlite3.OperationalError:
-    pass
-
-with open("init.sql", "r", encoding="utf-8") as f:
-    initscript = f.read()
-
-conn.executescript(initscript)
+import config
+import migrations
 
 ADJ = ["hieno", "mahtava", "paras", "nopea", "nopein", "pimeä", "kulmikas",
        "kuninkaallinen", "hieman hidas mutta melkein nopea", "turha",
@@ -32,84 +24,233 @@ USER_COUNT = 10000
 MAX_PROGRAMS_PER_USER = 500
 MAX_REVIEWS_PER_USER = 1000
 
-print("Seedaus kannattaa ajaa vain, jos tietokanta on tyhjä.", end=" ")
-res = input("Haluatko ajaa seedauksen? (E/k) ")
+# users generated by one task of a worker process
+CHUNK_SIZE = 100
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Täyttää tietokannan satunnaisilla käyttäjillä, "
+                    "ohjelmilla ja arvosteluilla.")
+    parser.add_argument("--output", default=config.DATABASE_FILE,
+                        help="tietokantatiedosto (oletus: %(default)s)")
+    parser.add_argument("--users", type=int, default=USER_COUNT,
+                        help="käyttäjien määrä (oletus: %(default)s)")
+    parser.add_argument("--max-programs", type=int,
+                        default=MAX_PROGRAMS_PER_USER,
+                        help="ohjelmia enintään käyttäjää kohden "
+                             "(oletus: %(default)s)")
+    parser.add_argument("--max-reviews", type=int,
+                        default=MAX_REVIEWS_PER_USER,
+                        help="arvosteluita enintään käyttäjää kohden "
+                             "(oletus: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="satunnaislukugeneraattorin siemen "
+                             "(oletus: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="dataa generoivien prosessien määrä "
+                             "(oletus: %(default)s)")
+    parser.add_argument("--reset", action="store_true",
+                        help="poistaa olemassa olevan tietokannan ensin")
+    return parser.parse_args(args)
+
+# Every user has their own random number generator, so the data does not
+# depend on how the users are split between worker processes
+def user_random(rng_seed, user_id):
+    return random.Random(f"{rng_seed}:{user_id}")
+
+def generate_users(task):
+    (rng_seed, first_user, last_user, first_program, program_count,
+     max_programs, max_reviews, classes) = task
+
+    programs = []
+    class_values = []
+    reviews = []
+    program_id = first_program
+
+    for user_id in range(first_user, last_user + 1):
+        rng = user_random(rng_seed, user_id)
+
+        for i in range(rng.randint(1, max_programs)):
+            name = f"{rng.choice(ADJ)} {rng.choice(NOUN)} {user_id}-{i}"
+            url = "https://example.com/" + name.replace(" ", "-")
+            description = "ehkä paras projektini ikinä.\n\n"
+            description += "tein sellasen ohjelman joka vähän tekee niitä ja näitä"
+            description += ". sen nimi on " + name + ". "
+            description += "se tekee hienoja asioita, kannattaa kokeilla."
+
+            programs.append((program_id, user_id, name, url, url, description))
+
+            for options in classes:
+                class_values.append((program_id, rng.choice(options)))
+
+            program_id += 1
+
+        reviewed = set()
+
+        for i in range(rng.randint(1, max_reviews)):
+            grade = rng.randint(1, 5)
+            comment = f"ihan {rng.choice(ADJ)} ohjelma. vähän vois parantaa."
+            reviewed_program = rng.randint(1, program_count)
+
+            # reviewed this program already, just ignore it and move on
+            if reviewed_program in reviewed:
+                continue
+
+            reviewed.add(reviewed_program)
+            reviews.append((user_id, reviewed_program, grade, comment))
 
-if res.lower() != "k":
-    print("Peruttu")
-    sys.exit(0)
+    return programs, class_values, reviews
 
-print("Luodaan käyttäjät...")
+def create_schema(conn):
+    with open("schema.sql", "r", encoding="utf-8") as f:
+        conn.executescript(f.read())
 
-users = []
+    conn.execute(f"PRAGMA user_version = {migrations.SCHEMA_VERSION}")
 
-for i in range(USER_COUNT):
-    username = "käyttäjä" + str(i + 1)
-    password = "********"
-    sql = "INSERT INTO users (username, password) VALUES (?, ?)"
+    with open("init.sql", "r", encoding="utf-8") as f:
+        conn.executescript(f.read())
 
-    res = conn.execute(sql, [username, password])
-    users.append(res.lastrowid)
+    with open("search.sql", "r", encoding="utf-8") as f:
+        try:
+            conn.executescript(f.read())
+        except sqlite3.OperationalError:
+            # SQLite without FTS5, search falls back to scanning
+            pass
+
+def seed(output, users=USER_COUNT, max_programs=MAX_PROGRAMS_PER_USER,
+         max_reviews=MAX_REVIEWS_PER_USER, rng_seed=0, workers=1,
+         log=print):
+    start = time.perf_counter()
+    conn = sqlite3.connect(output)
+
+    if conn.execute("SELECT 1 FROM sqlite_master").fetchone() is None:
+        create_schema(conn)
+    elif conn.execute("SELECT 1 FROM users").fetchone() is not None:
+        raise ValueError("tietokannassa on jo käyttäjiä")
+
+    # nothing is worth keeping if the seeding fails halfway, so the load
+    # runs without a journal or waiting for the disk
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA cache_size = -262144")
+    conn.execute("PRAGMA locking_mode = EXCLUSIVE")
+
+    # the indexes are created again after the load, which is much faster
+    # than updating them for every row
+    indexes = conn.execute("""SELECT name, sql FROM sqlite_master
+                              WHERE type = 'index' AND sql IS NOT NULL""")
+    indexes = indexes.fetchall()
+
+    for name, _ in indexes:
+        conn.execute(f"DROP INDEX {name}")
+
+    sql = """SELECT v.class, v.id FROM class_value v ORDER BY v.class, v.id"""
+    classes = {}
+    for class_id, value_id in conn.execute(sql):
+        classes.setdefault(class_id, []).append(value_id)
+    classes = list(classes.values())
+
+    log("Luodaan käyttäjät...")
 
-print("Luodaan ohjelmat...")
+    sql = "INSERT INTO users (id, username, password) VALUES (?, ?, ?)"
+    conn.executemany(sql, ((user_id, "käyttäjä" + str(user_id), "********")
+                           for user_id in range(1, users + 1)))
 
-# get all classes
-sql = """SELECT c.name, v.value, v.id, c.id FROM classes c, class_value v
-         WHERE v.class = c.id ORDER BY c.name, v.value"""
-res = conn.execute(sql)
+    log("Luodaan ohjelmat ja arvostelut...")
 
-classes = {}
-for class_value in res:
-    # (class_name, class_id)
-    key = (class_value[0], class_value[3])
+    # the number of programs of every user is drawn first, so that program
+    # IDs can be given to the users before generating anything else
+    program_counts = [user_random(rng_seed, user_id).randint(1, max_programs)
+                      for user_id in range(1, users + 1)]
+    program_count = sum(program_counts)
 
-    if key not in classes:
-        classes[key] = []
+    tasks = []
+    first_program = 1
+    for first_user in range(1, users + 1, CHUNK_SIZE):
+        last_user = min(first_user + CHUNK_SIZE - 1, users)
+        tasks.append((rng_seed, first_user, last_user, first_program,
+                      program_count, max_programs, max_reviews, classes))
+        first_program += sum(program_counts[first_user - 1:last_user])
 
-    classes[key].append((class_value[1], class_value[2]))
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        chunks = pool.imap(generate_users, tasks)
+    else:
+        pool = None
+        chunks = map(generate_users, tasks)
 
-classes = [(clas[0][0], clas[0][1], clas[1])
-           for clas in classes.items()]
+    for programs, class_values, reviews in chunks:
+        sql = """INSERT INTO programs (id, author, name, source_link,
+                 download_link, description) VALUES (?, ?, ?, ?, ?, ?)"""
+        conn.executemany(sql, programs)
 
-programs = []
+        sql = "INSERT INTO program_class_value (program, value) VALUES (?, ?)"
+        conn.executemany(sql, class_values)
 
-for user_id in users:
-    for i in range(random.randint(1, MAX_PROGRAMS_PER_USER)):
-        name = f"{random.choice(ADJ)} {random.choice(NOUN)} {user_id}-{i}"
-        url = "https://example.com/" + name.replace(" ", "-")
-        description = "ehkä paras projektini ikinä.\n\n"
-        description += "tein sellasen ohjelman joka vähän tekee niitä ja näitä"
-        description += ". sen nimi on " + name + ". "
-        description += "se tekee hienoja asioita, kannattaa kokeilla."
+        sql = """INSERT INTO reviews (author, program, grade, comment)
+                 VALUES (?, ?, ?, ?)"""
+        conn.executemany(sql, reviews)
 
-        values = [random.choice(clas[2])[1] for clas in classes]
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        sql = """INSERT INTO programs (author, name, source_link, download_link,
-                 description) VALUES (?, ?, ?, ?, ?)"""
-        program_id = conn.execute(sql, [user_id, name, url,
-                                url, description]).lastrowid
+    log("Luodaan indeksit...")
 
-        programs.append(program_id)
+    for _, sql in indexes:
+        conn.execute(sql)
 
-        for value in values:
-            sql = "INSERT INTO program_class_value (program, value) VALUES (?, ?)"
-            conn.execute(sql, [program_id, value])
+    log("Lasketaan koosteet...")
 
-print("Luodaan arvostelut...")
+    with open("aggregates.sql", "r", encoding="utf-8") as f:
+        for statement in f.read().split(";"):
+            if statement.strip():
+                conn.execute(statement)
 
-for user_id in users:
-    for i in range(random.randint(1, MAX_REVIEWS_PER_USER)):
-        grade = random.randint(1, 5)
-        comment = f"ihan {random.choice(ADJ)} ohjelma. vähän vois parantaa."
-        program_id = random.choice(programs)
+    log("Lasketaan järjestykset...")
 
+    # the seeded reviews have no times, so they do not count as trending and
+    # this is what a full refresh of the rankings would compute
+    sql = """UPDATE ranking_state SET refreshed = ?, mean =
+             (SELECT IFNULL(SUM(grade_sum) * 1.0 / SUM(review_count), 0)
+             FROM programs)"""
+    conn.execute(sql, [int(time.time())])
+
+    sql = """INSERT INTO program_ranking (program, top, trending, reviews)
+             SELECT p.id, (? * s.mean + p.grade_sum) / (? + p.review_count), 0,
+             p.review_count FROM programs p, ranking_state s"""
+    conn.execute(sql, [config.RANKING_PRIOR_REVIEWS] * 2)
+
+    sql = "SELECT 1 FROM sqlite_master WHERE name = 'programs_fts'"
+    if conn.execute(sql).fetchone() is not None:
+        conn.execute("INSERT INTO programs_fts (programs_fts) VALUES ('rebuild')")
+
+    conn.commit()
+
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA locking_mode = NORMAL")
+    conn.execute(f"PRAGMA journal_mode = {config.DB_JOURNAL_MODE}")
+    conn.close()
+
+    log(f"Valmis {time.perf_counter() - start:.1f} sekunnissa: {users} "
+        f"käyttäjää, {program_count} ohjelmaa")
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    if args.reset:
         try:
-            sql = """INSERT INTO reviews (author, program, grade, comment)
-                     VALUES (?, ?, ?, ?)"""
-            conn.execute(sql, [user_id, program_id, grade, comment])
-        except sqlite3.IntegrityError:
-            # reviewed this program already, just ignore it and move on
+            os.remove(args.output)
+        except FileNotFoundError:
             pass
 
-conn.commit()
-conn.close()
+    try:
+        seed(args.output, args.users, args.max_programs, args.max_reviews,
+             args.seed, args.workers)
+    except ValueError as e:
+        print(f"Virhe: {e}. Käytä --reset, jos haluat luoda tietokannan "
+              "alusta.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+# the modules and the SQL files they read are found from the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import config
+
+# nothing runs in the background and nothing is cached between tests
+config.CACHE_BACKEND = None
+config.PASSWORD_WORKERS = 0
+config.OUTBOX_WORKERS = 0
+config.PROFILE_REQUESTS = False
+
+from db import Database, db
+
+
+# An empty database of the latest schema used by the db of all modules
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DATABASE_FILE", str(tmp_path / "test.db"))
+    db._database = Database(config.DATABASE_FILE)
+
+    yield db._database
+
+    db.release()
+    db._database = None
+
+@pytest.fixture
+def author(database):
+    import user
+
+    user.create_user("tekijä", "salasana")
+    sql = "SELECT id FROM users WHERE username = 'tekijä'"
+    return database.query(sql)[0][0]
+
+# Returns a function creating a program with the first value of every class
+@pytest.fixture
+def make_program(database, author):
+    import program
+
+    values = [clas.options[0].id for clas in program.get_classes()]
+    names = iter(range(10 ** 6))
+
+    def make(author_id=author):
+        return program.create_program(author_id, f"ohjelma {next(names)}",
+                                      "https://example.com",
+                                      "https://example.com", "kuvaus", values)
+    return make
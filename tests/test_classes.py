@@ -0,0 +1,90 @@
+import pytest
+
+import config
+import program
+from app import app
+from db import Database
+
+
+def add_value(database, value):
+    sql = "INSERT INTO class_value (class, value) VALUES (1, ?)"
+    database.execute(sql, [value])
+
+def value_names(catalogue):
+    return {name for _, name in catalogue.values.values()}
+
+def test_catalogue_is_cached_within_ttl(database, monkeypatch):
+    monkeypatch.setattr(config, "CLASS_CACHE_TTL", 60)
+    catalogue = program.get_class_catalogue()
+
+    add_value(database, "Uusi")
+
+    assert program.get_class_catalogue() is catalogue
+    assert "Uusi" not in value_names(program.get_class_catalogue())
+
+def test_catalogue_is_loaded_again_after_ttl(database, monkeypatch):
+    monkeypatch.setattr(config, "CLASS_CACHE_TTL", 60)
+    catalogue = program.get_class_catalogue()
+
+    add_value(database, "Uusi")
+    catalogue.loaded -= 61
+
+    assert "Uusi" in value_names(program.get_class_catalogue())
+
+def test_invalidate_classes_loads_catalogue_again(database):
+    program.get_class_catalogue()
+    add_value(database, "Uusi")
+    program.invalidate_classes()
+
+    assert "Uusi" in value_names(program.get_class_catalogue())
+
+def test_changed_init_script_invalidates_catalogue(database):
+    database.execute("DELETE FROM class_value WHERE value = 'Python'")
+    database.execute("UPDATE init_script SET hash = ''")
+    database.release()
+    assert "Python" not in value_names(program.get_class_catalogue())
+
+    # the script inserts the deleted value again when the database is opened
+    Database(config.DATABASE_FILE)
+
+    assert "Python" in value_names(program.get_class_catalogue())
+
+@pytest.fixture
+def client(author):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = author
+        session["username"] = "tekijä"
+        session["csrf_token"] = "token"
+
+    return client
+
+def create_form(values):
+    form = {"name": "ohjelma", "source_link": "https://example.com",
+            "download_link": "https://example.com", "description": "kuvaus",
+            "csrf_token": "token"}
+    form.update(values)
+    return form
+
+def test_create_accepts_options_of_each_class(client):
+    classes = program.get_classes()
+    values = {f"class{clas.id}": clas.options[0].id for clas in classes}
+
+    assert client.post("/create", data=create_form(values)).status_code == 302
+
+@pytest.mark.parametrize("value", ["other class", "unknown", "text"])
+def test_create_refuses_unknown_options(client, value):
+    first, second = program.get_classes()[:2]
+    values = {f"class{clas.id}": clas.options[0].id
+              for clas in program.get_classes()}
+
+    if value == "other class":
+        values[f"class{first.id}"] = second.options[0].id
+    elif value == "unknown":
+        unknown = max(program.get_class_catalogue().values) + 1
+        values[f"class{first.id}"] = unknown
+    else:
+        values[f"class{first.id}"] = "Python"
+
+    assert client.post("/create", data=create_form(values)).status_code == 400
+    assert program.get_programs().programs == []
@@ -0,0 +1,51 @@
+import config
+from app import app
+from program import get_classes, get_facets
+
+
+def first_option(facets):
+    return facets[0].options[0]
+
+def test_values_are_counted(make_program):
+    for _ in range(3):
+        make_program()
+
+    option = first_option(get_facets([], "ohjelma"))
+    assert (option.count, option.more) == (3, False)
+
+    option = first_option(get_facets([option.id]))
+    assert (option.count, option.more, option.selected) == (3, False, True)
+
+def test_counts_over_the_limit_are_lower_bounds(make_program, monkeypatch):
+    monkeypatch.setattr(config, "FACET_COUNT_LIMIT", 2)
+
+    for _ in range(3):
+        make_program()
+
+    option = first_option(get_facets([], "ohjelma"))
+    assert option.count <= 3 and option.more
+
+def test_values_are_not_counted_without_counts(make_program):
+    make_program()
+    value = get_classes()[0].options[0].id
+
+    option = first_option(get_facets([value], "ohjelma", counts=False))
+    assert (option.count, option.selected) == (None, True)
+
+def test_later_pages_only_show_selected_values(make_program, monkeypatch):
+    program_id = make_program()
+    make_program()
+    clas = get_classes()[0]
+    value = clas.options[0].id
+
+    client = app.test_client()
+    first = client.get(f"/search?text=ohjelma&c={value}")
+    later = client.get(f"/search?text=ohjelma&c={value}&after={program_id}")
+
+    name = clas.options[0].name
+    assert f"{name} (2)" in first.get_data(as_text=True)
+    assert f"<b>{name} &times;</b>" in later.get_data(as_text=True)
+
+    monkeypatch.setattr(config, "FACET_COUNT_LIMIT", 1)
+    page = client.get("/search?text=ohjelma").get_data(as_text=True)
+    assert f"{name} (2+)" in page
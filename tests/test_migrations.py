@@ -0,0 +1,120 @@
+import sqlite3
+
+import migrations
+from db import Database
+
+# schema.sql before the schema was versioned
+ORIGINAL_SCHEMA = """
+CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT UNIQUE,
+                    password TEXT);
+CREATE TABLE programs (id INTEGER PRIMARY KEY,
+                       author INTEGER REFERENCES users, name TEXT UNIQUE,
+                       source_link TEXT, download_link TEXT, description TEXT);
+CREATE INDEX idx_pauthor ON programs (author);
+CREATE TABLE reviews (id INTEGER PRIMARY KEY, author INTEGER REFERENCES users,
+                      program INTEGER REFERENCES programs, grade INTEGER,
+                      comment TEXT, UNIQUE(author, program) ON CONFLICT ABORT);
+CREATE INDEX idx_reviews on reviews (program);
+CREATE TABLE classes (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+CREATE TABLE class_value (id INTEGER PRIMARY KEY,
+                          class INTEGER REFERENCES classes, value TEXT,
+                          UNIQUE(class, value) ON CONFLICT ABORT);
+CREATE TABLE program_class_value (program INTEGER REFERENCES programs,
+                                  value INTEGER REFERENCES class_value);
+CREATE INDEX idx_pcv on program_class_value (program);
+"""
+
+def columns(conn, table):
+    rows = conn.execute(f"PRAGMA table_info({table})")
+    return {column[1] for column in rows}
+
+def test_new_database_has_latest_schema(tmp_path):
+    conn = sqlite3.connect(tmp_path / "new.db")
+
+    assert migrations.migrate(conn) == 0
+    assert migrations.schema_version(conn) == migrations.SCHEMA_VERSION
+    assert "created" in columns(conn, "reviews")
+
+def test_migrated_schema_matches_new_schema(tmp_path):
+    new = sqlite3.connect(tmp_path / "new.db")
+    migrations.migrate(new)
+
+    old = sqlite3.connect(tmp_path / "old.db")
+    old.executescript(ORIGINAL_SCHEMA)
+
+    assert migrations.migrate(old) == migrations.SCHEMA_VERSION
+    assert migrations.schema_version(old) == migrations.SCHEMA_VERSION
+
+    sql = "SELECT name FROM sqlite_master WHERE type = 'table'"
+    tables = {row[0] for row in new.execute(sql)}
+    assert tables == {row[0] for row in old.execute(sql)}
+
+    for table in tables:
+        assert columns(old, table) == columns(new, table), table
+
+    sql = """SELECT name FROM sqlite_master
+             WHERE type = 'index' AND sql IS NOT NULL"""
+    assert ({row[0] for row in old.execute(sql)}
+            == {row[0] for row in new.execute(sql)})
+
+def test_migration_computes_aggregates_and_rankings(tmp_path):
+    conn = sqlite3.connect(tmp_path / "old.db")
+    conn.executescript(ORIGINAL_SCHEMA)
+    conn.executescript("""
+        INSERT INTO users (id, username) VALUES (1, 'a'), (2, 'b');
+        INSERT INTO programs (id, author, name)
+        VALUES (1, 1, 'x'), (2, 1, 'y');
+        INSERT INTO reviews (author, program, grade)
+        VALUES (2, 1, 5), (1, 1, 3);
+    """)
+    conn.commit()
+
+    migrations.migrate(conn)
+
+    assert conn.execute("""SELECT review_count, grade_sum FROM programs
+                           ORDER BY id""").fetchall() == [(2, 8), (0, 0)]
+    sql = """SELECT program_count, received_grade_sum, received_weight
+             FROM users WHERE id = 1"""
+    assert conn.execute(sql).fetchone() == (2, 8, 3)
+    assert conn.execute("SELECT mean FROM ranking_state").fetchone() == (4.0,)
+    sql = """SELECT program, reviews, trending FROM program_ranking
+             ORDER BY program"""
+    assert conn.execute(sql).fetchall() == [(1, 2, 0), (2, 0, 0)]
+
+def test_up_to_date_database_is_not_migrated_again(tmp_path):
+    conn = sqlite3.connect(tmp_path / "new.db")
+    migrations.migrate(conn)
+
+    assert migrations.migrate(conn) == 0
+
+def test_failed_migration_is_rolled_back(tmp_path, monkeypatch):
+    conn = sqlite3.connect(tmp_path / "old.db")
+    conn.executescript(ORIGINAL_SCHEMA)
+
+    def broken(conn):
+        conn.execute("CREATE TABLE half (id INTEGER)")
+        raise sqlite3.OperationalError("broken")
+
+    monkeypatch.setattr(migrations, "MIGRATIONS",
+                        migrations.MIGRATIONS[:2] + [broken])
+    monkeypatch.setattr(migrations, "SCHEMA_VERSION", 3)
+
+    try:
+        migrations.migrate(conn)
+    except sqlite3.OperationalError:
+        pass
+
+    assert migrations.schema_version(conn) == 2
+    assert conn.execute("""SELECT 1 FROM sqlite_master
+                           WHERE name = 'half'""").fetchone() is None
+
+def test_database_analyzes_after_migrating(tmp_path):
+    conn = sqlite3.connect(tmp_path / "old.db")
+    conn.executescript(ORIGINAL_SCHEMA)
+    conn.close()
+
+    database = Database(str(tmp_path / "old.db"))
+
+    sql = "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+    assert database.query(sql)
+    database.release()
@@ -0,0 +1,175 @@
+import pytest
+
+import config
+import outbox
+import user
+
+
+@pytest.fixture
+def recorded(database, monkeypatch):
+    calls = []
+    monkeypatch.setitem(outbox.handlers, "test", calls.append)
+    return calls
+
+def pending(database):
+    return database.query("SELECT COUNT(*) FROM outbox")[0][0]
+
+def test_events_are_handled_in_one_batch(database, recorded):
+    for i in range(3):
+        outbox.enqueue("test", i)
+
+    assert outbox.process_batch() == 3
+    assert recorded == [[0, 1, 2]]
+    assert pending(database) == 0
+
+def test_batch_size_is_limited(database, recorded):
+    for i in range(5):
+        outbox.enqueue("test", i)
+
+    assert outbox.process_batch(limit=2) == 2
+    assert outbox.process_batch(limit=2) == 2
+    assert outbox.process_batch(limit=2) == 1
+    assert recorded == [[0, 1], [2, 3], [4]]
+
+def test_batch_size_is_read_from_config(database, recorded, monkeypatch):
+    monkeypatch.setattr(config, "OUTBOX_BATCH_SIZE", 2)
+
+    for i in range(3):
+        outbox.enqueue("test", i)
+
+    assert outbox.process_batch() == 2
+
+def test_enqueue_does_not_start_workers(database, recorded, monkeypatch):
+    monkeypatch.setattr(config, "OUTBOX_WORKERS", 1)
+
+    with database.transaction():
+        outbox.enqueue("test", 1)
+
+    assert outbox.queue_stats().workers == 0
+
+def test_event_of_rolled_back_transaction_is_dropped(database, recorded):
+    with pytest.raises(RuntimeError):
+        with database.transaction():
+            outbox.enqueue("test", 1)
+            raise RuntimeError
+
+    assert outbox.process_batch() == 0
+    assert recorded == []
+
+def test_failed_batch_is_retried_after_the_lease(database, monkeypatch):
+    failures = [ValueError("first"), None]
+    handled = []
+
+    def flaky(payloads):
+        failure = failures.pop(0)
+        if failure is not None:
+            raise failure
+        handled.extend(payloads)
+
+    monkeypatch.setitem(outbox.handlers, "flaky", flaky)
+    outbox.enqueue("flaky", 1)
+
+    assert outbox.process_batch() == 0
+    # the event is leased to the failed worker
+    assert outbox.process_batch() == 0
+    assert pending(database) == 1
+
+    monkeypatch.setattr(config, "OUTBOX_LEASE", 0)
+    database.execute("UPDATE outbox SET available = 0")
+
+    assert outbox.process_batch() == 1
+    assert handled == [1]
+    assert pending(database) == 0
+
+def test_event_failing_too_often_is_dead(database, monkeypatch):
+    def broken(payloads):
+        raise ValueError
+
+    monkeypatch.setitem(outbox.handlers, "broken", broken)
+    monkeypatch.setattr(config, "OUTBOX_LEASE", 0)
+    monkeypatch.setattr(config, "OUTBOX_MAX_ATTEMPTS", 2)
+    outbox.enqueue("broken", 1)
+
+    for _ in range(3):
+        assert outbox.process_batch() == 0
+
+    assert database.query("SELECT attempts FROM outbox")[0][0] == 2
+
+    stats = outbox.queue_stats()
+    assert stats.pending == 1
+    assert stats.dead == 1
+    assert stats.lag_seconds == 0.0
+
+def test_unknown_topic_does_not_stop_others(database, recorded):
+    outbox.enqueue("unknown", 1)
+    outbox.enqueue("test", 2)
+
+    assert outbox.process_batch() == 1
+    assert recorded == [[2]]
+
+def test_queue_stats_show_lag(database, recorded):
+    outbox.enqueue("test", 1)
+    database.execute("UPDATE outbox SET created = created - 60")
+
+    stats = outbox.queue_stats()
+    assert stats.pending == 1
+    assert stats.dead == 0
+    assert stats.lag_seconds >= 60
+
+def test_user_stats_are_updated_and_can_be_repeated(database, author,
+                                                    make_program):
+    import program
+
+    database.execute("INSERT INTO users (username) VALUES ('arvioija')")
+    reviewer = database.query("SELECT id FROM users WHERE username = ?",
+                              ["arvioija"])[0][0]
+
+    program_id = make_program()
+    make_program()
+    program.review_program(program_id, reviewer, 4, "hyvä")
+
+    assert outbox.process_batch() == 3
+
+    sql = """SELECT program_count, received_grade_sum, received_weight,
+             review_count, grade_sum FROM users WHERE id = ?"""
+    expected_author = (2, 4, 2, 0, 0)
+    expected_reviewer = (0, 0, 0, 1, 4)
+    assert database.query(sql, [author])[0] == expected_author
+    assert database.query(sql, [reviewer])[0] == expected_reviewer
+
+    # an event handled again changes nothing
+    with database.transaction():
+        user.refresh_user_stats([[author, reviewer]])
+
+    assert database.query(sql, [author])[0] == expected_author
+    assert database.query(sql, [reviewer])[0] == expected_reviewer
+
+def test_user_stats_only_change_versions_of_their_users(database, author,
+                                                        make_program,
+                                                        monkeypatch):
+    import app as app_module
+    from cache import MemoryCache
+    from program import get_content_version
+
+    monkeypatch.setattr(app_module, "cache", MemoryCache(100))
+    client = app_module.app.test_client()
+
+    def program_count():
+        page = client.get(f"/u/{author}").get_data(as_text=True)
+        return page.split("Ohjelmien määrä: ")[1].split("<")[0]
+
+    make_program()
+    outbox.process_batch()
+    assert program_count() == "1"
+
+    make_program()
+    content_version = get_content_version()
+    user_version = user.get_user_version(author)[0]
+
+    # the page is cached before the statistics are updated
+    assert program_count() == "1"
+    outbox.process_batch()
+
+    assert get_content_version() == content_version
+    assert user.get_user_version(author)[0] > user_version
+    assert program_count() == "2"
@@ -0,0 +1,93 @@
+import pytest
+
+import config
+from pagination import keyset, page_cursors, split_page
+from program import get_programs
+
+
+@pytest.fixture(autouse=True)
+def small_pages(monkeypatch):
+    monkeypatch.setattr(config, "ITEMS_PER_PAGE", 3)
+
+def test_first_page_uses_offset():
+    keys = keyset("p.id", True, page=2)
+
+    assert keys.conditions == []
+    assert keys.order == "DESC"
+    assert keys.offset == 6
+    assert keys.limit == 4
+    assert keys.has_previous
+
+def test_after_cursor_continues_in_order():
+    keys = keyset("p.id", True, after=10)
+
+    assert keys.conditions == ["p.id < ?"]
+    assert keys.params == [10]
+    assert keys.order == "DESC"
+    assert not keys.reverse
+
+def test_before_cursor_scans_backwards():
+    keys = keyset("p.id", True, before=10)
+
+    assert keys.conditions == ["p.id > ?"]
+    assert keys.order == "ASC"
+    assert keys.reverse
+
+def test_row_value_cursor():
+    keys = keyset("(r.top, r.program)", True, after=5, value="(SELECT 1, ?)")
+
+    assert keys.conditions == ["(r.top, r.program) < (SELECT 1, ?)"]
+    assert keys.params == [5]
+
+def test_split_page_reverses_backward_pages():
+    keys = keyset("p.id", True, before=10)
+    rows, has_more, has_previous = split_page([11, 12, 13, 14], keys)
+
+    assert rows == [13, 12, 11]
+    assert has_more
+    assert has_previous
+
+def test_split_page_last_page():
+    keys = keyset("p.id", True, after=10)
+    rows, has_more, has_previous = split_page([9, 8], keys)
+
+    assert rows == [9, 8]
+    assert not has_more
+    assert has_previous
+
+def test_page_cursors_of_empty_page():
+    assert page_cursors([], True, True) == (None, None)
+
+def test_cursors_page_through_all_programs(make_program):
+    ids = [make_program() for _ in range(8)]
+    newest_first = ids[::-1]
+
+    pages = []
+    listing = get_programs()
+    pages.append([program.id for program in listing.programs])
+
+    while listing.has_more:
+        listing = get_programs(after=listing.programs[-1].id)
+        pages.append([program.id for program in listing.programs])
+
+    assert pages == [newest_first[0:3], newest_first[3:6], newest_first[6:]]
+    assert listing.has_previous
+
+    # and back again from the last page
+    listing = get_programs(before=pages[2][0])
+    assert [program.id for program in listing.programs] == pages[1]
+    assert listing.has_more
+    assert listing.has_previous
+
+    listing = get_programs(before=pages[1][0])
+    assert [program.id for program in listing.programs] == pages[0]
+    assert not listing.has_previous
+
+def test_page_numbers_match_cursors(make_program):
+    for _ in range(7):
+        make_program()
+
+    by_number = get_programs(page=1).programs
+    by_cursor = get_programs(after=get_programs().programs[-1].id).programs
+
+    assert by_number == by_cursor
@@ -0,0 +1,49 @@
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import config
+import passwords
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    monkeypatch.setattr(config, "PASSWORD_WORKERS", 1)
+    # a cheap hash, the parameters do not matter here
+    monkeypatch.setattr(config, "PASSWORD_HASH_METHOD", "pbkdf2:sha256:1000")
+
+    yield
+
+    if passwords._pool is not None:
+        passwords._pool.shutdown()
+        passwords._pool = None
+
+def test_pool_is_replaced_after_worker_dies(workers):
+    password_hash = passwords.hash_password("salasana")
+    broken = passwords._pool
+
+    for process in list(broken._processes.values()):
+        process.kill()
+        process.join()
+
+    assert passwords.check_password(password_hash, "salasana")
+    assert passwords._pool is not broken
+    assert passwords._pending == 0
+
+class BrokenPool:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def submit(self, function, *args):
+        raise BrokenProcessPool
+
+    def shutdown(self, wait=True):
+        pass
+
+def test_pool_breaking_again_is_refused(workers, monkeypatch):
+    monkeypatch.setattr(passwords, "ProcessPoolExecutor", BrokenPool)
+
+    with pytest.raises(passwords.HashQueueFull):
+        passwords.hash_password("salasana")
+
+    assert passwords._pending == 0
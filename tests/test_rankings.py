@@ -0,0 +1,131 @@
+import math
+
+import pytest
+
+import config
+import program
+from program import (
+    bayesian_average,
+    get_programs,
+    refresh_rankings,
+    trending_score,
+)
+
+
+@pytest.fixture(autouse=True)
+def small_pages(monkeypatch):
+    monkeypatch.setattr(config, "ITEMS_PER_PAGE", 3)
+
+@pytest.fixture
+def reviewers(database):
+    database.executemany("INSERT INTO users (username) VALUES (?)",
+                         [[f"arvioija {i}"] for i in range(5)])
+    sql = "SELECT id FROM users WHERE username LIKE 'arvioija%' ORDER BY id"
+    return [row[0] for row in database.query(sql)]
+
+def ids(listing):
+    return [card.id for card in listing.programs]
+
+def test_bayesian_average_pulls_few_reviews_towards_mean(monkeypatch):
+    monkeypatch.setattr(config, "RANKING_PRIOR_REVIEWS", 5)
+
+    assert bayesian_average(0, 0, 3.0) == 3.0
+    assert bayesian_average(5, 1, 3.0) < bayesian_average(40, 10, 3.0)
+
+def test_trending_score_prefers_recent_reviews(monkeypatch):
+    monkeypatch.setattr(config, "TRENDING_HALF_LIFE", 100)
+
+    assert trending_score([]) == 0.0
+    # a review one half-life newer weighs twice as much
+    assert trending_score([1100]) - trending_score([1000]) == pytest.approx(1)
+    assert trending_score([1000, 1000]) == pytest.approx(
+        trending_score([1100]))
+
+def test_trending_score_does_not_overflow(monkeypatch):
+    monkeypatch.setattr(config, "TRENDING_HALF_LIFE", 1)
+
+    score = trending_score([2 * 10 ** 9, 2 * 10 ** 9])
+    assert math.isfinite(score)
+    assert score == pytest.approx(2 * 10 ** 9 + 1)
+
+def test_new_program_is_ranked_at_once(database, make_program):
+    program_id = make_program()
+
+    assert ids(get_programs(sort="top")) == [program_id]
+
+def test_refresh_ranks_reviewed_programs(database, make_program, reviewers):
+    programs = [make_program() for _ in range(3)]
+
+    for reviewer in reviewers:
+        program.review_program(programs[0], reviewer, 5, "hyvä")
+    program.review_program(programs[1], reviewers[0], 1, "huono")
+
+    assert refresh_rankings(full=True) == 3
+
+    assert ids(get_programs(sort="top")) == [programs[0], programs[2],
+                                             programs[1]]
+    assert ids(get_programs(sort="most_reviewed"))[0] == programs[0]
+
+def test_incremental_refresh_only_updates_changed(database, make_program,
+                                                  reviewers):
+    programs = [make_program() for _ in range(4)]
+    refresh_rankings(full=True)
+
+    # the refresh starts from the second of the previous refresh
+    database.execute("UPDATE programs SET modified = 0")
+    database.execute("UPDATE ranking_state SET refreshed = 1")
+    program.review_program(programs[2], reviewers[0], 5, "hyvä")
+
+    assert refresh_rankings() == 1
+    assert ids(get_programs(sort="trending"))[0] == programs[2]
+
+def test_full_refresh_changes_content_version(database, make_program):
+    make_program()
+    version = program.get_content_version()
+
+    refresh_rankings(full=True)
+
+    assert program.get_content_version() > version
+
+def test_sorted_listing_pages_both_ways(database, make_program, reviewers):
+    programs = [make_program() for _ in range(8)]
+
+    # ties in the score are ordered by the program ID
+    for i, program_id in enumerate(programs):
+        database.execute("""UPDATE program_ranking SET reviews = ?
+                            WHERE program = ?""", [i % 3, program_id])
+
+    first = get_programs(sort="most_reviewed")
+    second = get_programs(sort="most_reviewed", after=ids(first)[-1])
+    third = get_programs(sort="most_reviewed", after=ids(second)[-1])
+
+    order = sorted(programs, key=lambda p: (programs.index(p) % 3, p),
+                   reverse=True)
+    assert ids(first) + ids(second) + ids(third) == order
+    assert not third.has_more
+
+    back = get_programs(sort="most_reviewed", before=ids(third)[0])
+    assert ids(back) == ids(second)
+
+def test_cursor_of_deleted_program_keeps_its_place(database, make_program):
+    programs = [make_program() for _ in range(6)]
+    first = get_programs(sort="top")
+    second = get_programs(sort="top", after=ids(first)[-1])
+
+    deleted = ids(first)[-1]
+    program.delete_program(deleted)
+
+    assert ids(get_programs(sort="top", after=deleted)) == ids(second)
+
+    # after a full refresh the listing starts over
+    refresh_rankings(full=True)
+    programs.remove(deleted)
+    listing = get_programs(sort="top", after=deleted)
+    assert ids(listing) == sorted(programs, reverse=True)[:3]
+
+def test_filters_apply_to_sorted_listing(database, make_program):
+    make_program()
+    clas = program.get_classes()[0]
+    other = clas.options[1].id
+
+    assert ids(get_programs(sort="top", values=[other])) == []
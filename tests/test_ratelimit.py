@@ -0,0 +1,55 @@
+import pytest
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import app as app_module
+from app import app
+from ratelimit import RateLimiter
+
+
+@pytest.fixture
+def limits(database, monkeypatch):
+    monkeypatch.setattr(app_module, "login_ip_limiter", RateLimiter(3, 600))
+    monkeypatch.setattr(app_module, "login_username_limiter",
+                        RateLimiter(2, 600))
+    monkeypatch.setattr(app_module, "register_ip_limiter", RateLimiter(1, 600))
+
+def log_in(username, address, headers=None):
+    client = app.test_client()
+    form = {"username": username, "password": "väärä"}
+    response = client.post("/login", data=form, headers=headers,
+                           environ_base={"REMOTE_ADDR": address})
+    return response.status_code
+
+def register(username, address):
+    client = app.test_client()
+    form = {"username": username, "password1": "salasana",
+            "password2": "salasana"}
+    response = client.post("/register", data=form,
+                           environ_base={"REMOTE_ADDR": address})
+    return response.status_code
+
+def test_login_is_limited_per_address(limits):
+    codes = [log_in(f"tunnus{i}", "10.0.0.1") for i in range(4)]
+    assert codes == [200, 200, 200, 429]
+    assert log_in("tunnus4", "10.0.0.2") == 200
+
+def test_login_is_limited_per_username(limits):
+    assert log_in("tekijä", "10.0.0.1") == 200
+    assert log_in("TEKIJÄ", "10.0.0.2") == 200
+    assert log_in("Tekijä", "10.0.0.3") == 429
+    assert log_in("toinen", "10.0.0.3") == 200
+
+def test_registering_is_limited_per_address(limits):
+    assert register("tekijä", "10.0.0.1") == 302
+    assert register("toinen", "10.0.0.1") == 429
+    assert register("toinen", "10.0.0.2") == 302
+
+def test_clients_behind_proxy_have_own_limits(limits, monkeypatch):
+    monkeypatch.setattr(app, "wsgi_app", ProxyFix(app.wsgi_app, x_for=1))
+
+    def through_proxy(username, client):
+        return log_in(username, "10.0.0.1", {"X-Forwarded-For": client})
+
+    codes = [through_proxy(f"tunnus{i}", "192.0.2.1") for i in range(4)]
+    assert codes == [200, 200, 200, 429]
+    assert through_proxy("tunnus4", "192.0.2.2") == 200
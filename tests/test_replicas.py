@@ -0,0 +1,123 @@
+import os
+
+import pytest
+
+import config
+from db import Database, db
+from program import get_classes, get_content_version
+
+
+@pytest.fixture
+def primary(tmp_path, monkeypatch):
+    replica = str(tmp_path / "replica.db")
+    monkeypatch.setattr(config, "DATABASE_FILE", str(tmp_path / "test.db"))
+    monkeypatch.setattr(config, "DB_REPLICAS", [replica])
+    db._database = Database(config.DATABASE_FILE, replicas=[replica])
+
+    yield db._database
+
+    db.release()
+    db._database = None
+
+def user_count(database):
+    return database.query("SELECT COUNT(*) FROM users")[0][0]
+
+def add_user(database, name):
+    database.execute("INSERT INTO users (username) VALUES (?)", [name])
+    database.release()
+
+def test_missing_replica_is_not_used(primary):
+    assert not primary.use_replica()
+
+    add_user(primary, "a")
+    assert user_count(primary) == 1
+
+def test_reads_go_to_replica_until_a_write(primary):
+    primary.snapshot_replica(config.DB_REPLICAS[0])
+    add_user(primary, "a")
+
+    assert primary.use_replica()
+    assert user_count(primary) == 0
+
+    primary.execute("INSERT INTO users (username) VALUES ('b')")
+    assert primary.has_written()
+    assert user_count(primary) == 2
+
+    # the connection to the replica is back in its pool
+    stats = primary.replicas[0].stats()
+    assert stats.idle == stats.opened == 1
+
+    primary.release()
+    assert not primary.has_written()
+
+def test_replica_behind_the_version_is_skipped(primary):
+    primary.snapshot_replica(config.DB_REPLICAS[0])
+    primary.execute("UPDATE content_version SET version = version + 1")
+    version = get_content_version()
+    primary.release()
+
+    assert not primary.use_replica(version)
+    primary.release()
+
+    primary.snapshot_replica(config.DB_REPLICAS[0])
+    primary.release()
+    assert primary.use_replica(version)
+
+def test_new_snapshot_replaces_open_replica(primary):
+    primary.snapshot_replica(config.DB_REPLICAS[0])
+    assert primary.use_replica()
+    assert user_count(primary) == 0
+    primary.release()
+
+    add_user(primary, "a")
+    primary.snapshot_replica(config.DB_REPLICAS[0])
+    primary.release()
+
+    assert primary.use_replica()
+    assert user_count(primary) == 1
+    primary.release()
+
+    # only the connection to the new file is kept
+    assert primary.replicas[0].stats().opened == 1
+
+def test_removed_replica_falls_back_to_primary(primary):
+    primary.snapshot_replica(config.DB_REPLICAS[0])
+    primary.release()
+    os.remove(config.DB_REPLICAS[0])
+
+    assert not primary.use_replica()
+
+def test_writer_reads_own_writes(primary):
+    from app import app
+
+    primary.snapshot_replica(config.DB_REPLICAS[0])
+    add_user(primary, "tekijä")
+
+    writer = app.test_client()
+    with writer.session_transaction() as session:
+        session["user_id"] = 1
+        session["username"] = "tekijä"
+        session["csrf_token"] = "token"
+
+    form = {"name": "ohjelma", "source_link": "https://example.com",
+            "download_link": "https://example.com", "description": "kuvaus",
+            "csrf_token": "token"}
+    for clas in get_classes():
+        form[f"class{clas.id}"] = clas.options[0].id
+
+    response = writer.post("/create", data=form)
+    assert response.status_code == 302
+    program_url = response.location
+
+    anonymous = app.test_client()
+    assert writer.get(program_url).status_code == 200
+    assert anonymous.get(program_url).status_code == 404
+
+    primary.snapshot_replica(config.DB_REPLICAS[0])
+    primary.release()
+
+    assert anonymous.get(program_url).status_code == 200
+    assert writer.get(program_url).status_code == 200
+
+    with writer.session_transaction() as session:
+        assert "read_version" not in session
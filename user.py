@@ -1,15 +1,25 @@
 import sqlite3
+import time
 from dataclasses import dataclass
 
-from werkzeug.security import check_password_hash, generate_password_hash
-
-import config
+import outbox
 from db import db
-from program import Program
+from pagination import keyset, split_page
+from passwords import (
+    HashQueueFull,
+    check_password,
+    hash_password,
+    needs_rehash,
+)
+from program import AVERAGE_GRADE, ProgramCard
 
 
 def create_user(username, password):
-    password_hash = generate_password_hash(password)
+    # a taken username is noticed before spending time on the hash
+    if db.query("SELECT 1 FROM users WHERE username = ?", [username]):
+        raise UserExists
+
+    password_hash = hash_password(password)
     sql = "INSERT INTO users (username, password) VALUES (?, ?)"
 
     try:
@@ -28,58 +38,96 @@ def login(username, password) -> int:
 
     user_id, password_hash = queryres[0]
 
-    if not check_password_hash(password_hash, password):
+    if not check_password(password_hash, password):
         raise WrongCredentials
 
+    # the password is only known while logging in, so a hash made with old
+    # parameters is replaced now. The login succeeds anyway if the hash can
+    # not be computed now, it is replaced on a later login.
+    if needs_rehash(password_hash):
+        try:
+            db.execute("UPDATE users SET password = ? WHERE id = ?",
+                       [hash_password(password), user_id])
+        except HashQueueFull:
+            pass
+
     return user_id
 
+# Recomputes the statistics of the users in the payloads of a batch of
+# user_stats events, each a list of user IDs. A user changed by many events
+# of the batch is recomputed once, and recomputing is safe to repeat.
+@outbox.handler("user_stats")
+def refresh_user_stats(payloads):
+    user_ids = {user_id for payload in payloads for user_id in payload}
+
+    # a program without reviews counts as a single zero grade
+    sql = """UPDATE users SET
+             review_count = (SELECT COUNT(*) FROM reviews
+             WHERE author = users.id),
+             grade_sum = (SELECT IFNULL(SUM(grade), 0) FROM reviews
+             WHERE author = users.id),
+             program_count = (SELECT COUNT(*) FROM programs
+             WHERE author = users.id),
+             received_grade_sum = (SELECT IFNULL(SUM(grade_sum), 0)
+             FROM programs WHERE author = users.id),
+             received_weight = (SELECT IFNULL(SUM(MAX(review_count, 1)), 0)
+             FROM programs WHERE author = users.id),
+             version = version + 1, modified = ? WHERE id = ?"""
+    db.executemany(sql, [[int(time.time()), user_id] for user_id in user_ids])
+
+# The statistics are kept up to date in the background after changes to
+# programs and reviews, so they are read from the row of the user only
 def user_stats(user_id):
+    # a program without reviews counts as a single zero grade in the average
+    # grade of the programs of the user
+    sql = """SELECT username, IFNULL(grade_sum * 1.0 / review_count, 0),
+             review_count, IFNULL(received_grade_sum * 1.0 / received_weight, 0),
+             program_count FROM users WHERE id = ?"""
+
     try:
-        sql = """SELECT u.username, IFNULL(AVG(r.grade), 0), COUNT(r.id) FROM users u
-                 LEFT JOIN reviews r ON r.author = u.id WHERE u.id = ?"""
-        name, average_given_review, review_count = db.query(sql, [user_id])[0]
-
-        sql = """SELECT IFNULL(AVG(IFNULL(r.grade, 0)), 0), COUNT(DISTINCT p.id)
-                 FROM users u
-                 LEFT JOIN programs p ON p.author = u.id
-                 LEFT JOIN reviews r ON r.program = p.id
-                 WHERE u.id = ?"""
-        average_grade, program_count = db.query(sql, [user_id])[0]
+        (name, average_given_review, review_count, average_grade,
+         program_count) = db.query(sql, [user_id])[0]
     except IndexError:
         raise UserNotFound
 
     return UserStats(name, program_count, average_grade, average_given_review,
                      review_count)
 
-def user_programs(user_id, page=0):
-    try:
-        sql = """SELECT u.id, u.username, p.id, p.name, p.description,
-                 IFNULL(AVG(r.grade), 0) FROM users u
-                 LEFT JOIN programs p ON p.author = u.id
-                 LEFT JOIN reviews r ON r.program = p.id
-                 WHERE u.id = ? GROUP BY p.id ORDER BY p.id ASC
-                 LIMIT ? OFFSET ?"""
-        data = db.query(sql, [user_id, config.ITEMS_PER_PAGE + 1,
-                              config.ITEMS_PER_PAGE * page])
-
-        user_id = data[0][0]
-        name = data[0][1]
-    except IndexError:
+# Returns the version of the page of a user and the Unix time it was last
+# modified, 0 if unknown
+def get_user_version(user_id):
+    res = db.query("SELECT version, modified FROM users WHERE id = ?",
+                   [user_id])
+
+    if not res:
+        raise UserNotFound
+
+    return res[0]
+
+def user_programs(user_id, page=0, after=None, before=None):
+    keys = keyset("p.id", False, page, after, before)
+    where = " ".join("AND " + condition for condition in keys.conditions)
+
+    # the users table is joined first so that a user without (more)
+    # programs gives a single row with no program
+    sql = f"""SELECT p.id, p.name, p.description, u.username, u.id,
+              {AVERAGE_GRADE}, p.version FROM users u
+              LEFT JOIN programs p ON p.author = u.id {where}
+              WHERE u.id = ? ORDER BY p.id {keys.order}
+              LIMIT ? OFFSET ?"""
+    programs = db.query(sql, keys.params + [user_id, keys.limit, keys.offset],
+                        row_factory=ProgramCard.from_row)
+
+    if not programs:
         raise UserNotFound
 
     # PEP 8 recommended style
-    if data[0][2] is None:
+    if programs[0].id is None:
         programs = []
-    else:
-        programs = [Program(d[3], d[2], name, user_id, d[4], None, None, d[5], None) for d in data]
-
-    has_more = False
 
-    if len(programs) == config.ITEMS_PER_PAGE + 1:
-        programs = programs[:-1]
-        has_more = True
+    programs, has_more, has_previous = split_page(programs, keys)
 
-    return UserPrograms(programs, has_more)
+    return UserPrograms(programs, has_more, has_previous)
 
 @dataclass
 class UserStats:
@@ -91,8 +139,9 @@ class UserStats:
 
 @dataclass
 class UserPrograms:
-    programs: list[Program]
+    programs: list[ProgramCard]
     has_more: bool
+    has_previous: bool
 
 class UserExists(Exception):
     pass